@@ -1,22 +1,54 @@
 #Imports
 import json
 import logging
-from flask import Flask, request
+from flask import Flask, Response, request
 
 #Modules
+from modules.md_config import keys
 from modules.md_dialog_logic import Search
 from modules.md_messenger import Messenger
+from modules.md_send import make_session
+from modules.md_queue import WorkQueue
+from modules.md_metrics import metrics, enabled as metrics_enabled
+from modules.md_dialogflow import sessions
+from modules.md_fastpath import fastpath
+from modules.md_elasticsearch import search_cache
+from modules.md_redis import session_cache
+from modules import md_warmup
 
 app = Flask(__name__)
 
-#Keys
-with open("config/keys.json") as f:
-    keys = json.load(f)
-
 app.config['SECRET_KEY'] = keys['FLASK_SECRET_KEY']
 FB_ACCESS_TOKEN = keys['FB_ACCESS_TOKEN']
 FB_VERIFY_TOKEN = keys['FB_VERIFY_TOKEN']
-messenger = Messenger(FB_ACCESS_TOKEN)
+ASYNC_WEBHOOK = keys.get('ASYNC_WEBHOOK', False)
+send_session = make_session(keys.get('SEND_POOL_SIZE', 10), keys.get('SEND_RETRIES', 3),
+                            keys.get('SEND_BACKOFF', 0.3), keys.get('GRAPH_URL'))
+messenger = Messenger(FB_ACCESS_TOKEN, keys.get('DISPATCH_WORKERS', 8), send_session,
+                      keys.get('SEND_TIMEOUT', 10))
+
+
+#Worker queue for asynchronous webhook processing
+def process_event(event):
+
+    """Processes a single queued messaging event"""
+
+    with app.app_context():
+        messenger.handle({'object': 'page', 'entry': [{'messaging': [event]}]})
+
+work_queue = WorkQueue(process_event, keys.get('WEBHOOK_WORKERS', 32), keys.get('WEBHOOK_QUEUE_SIZE', 100))
+
+
+#Component stats exported next to the latency histograms
+metrics.register('dispatcher', messenger.dispatcher.stats)
+metrics.register('fastpath', fastpath.stats)
+metrics.register('dialogflow', sessions.stats, {'channel_reuse': 'channel'})
+if session_cache:
+    metrics.register('session_cache', session_cache.stats)
+if search_cache:
+    metrics.register('search_cache', search_cache.stats)
+if ASYNC_WEBHOOK:
+    metrics.register('webhook_queue', work_queue.stats)
 
 
 #Enable gunicorn logging
@@ -39,11 +71,40 @@ def receive_message():
         return 'FB_VERIFY_TOKEN does not match.'
 
     elif request.method == 'POST':
-        messenger.handle(request.get_json(force=True))
+        payload = request.get_json(force=True)
+        if not ASYNC_WEBHOOK:
+            messenger.handle(payload)
+            return 'OK'
+
+        #acknowledge immediately, events of one sender stay in order
+        if not isinstance(payload, dict) or payload.get('object') != 'page':
+            return 'Invalid payload.', 400
+        events = [(event['sender']['id'], event)
+                  for entry in payload.get('entry', [])
+                  for event in entry.get('messaging', [])
+                  if event.get('sender', {}).get('id') is not None]
+        #full or shutting down, Facebook retries the whole batch later
+        if not work_queue.put(events):
+            return 'Busy.', 503
         return 'OK'
     return ''
 
 
+@app.route("/metrics")
+def export_metrics():
+    if not metrics_enabled:
+        return 'Metrics are disabled.', 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+#Readiness check, (re)starts the warmup in the background until it succeeded
+@app.route("/warmup")
+def warm():
+    md_warmup.start()
+    report = md_warmup.last_report or {}
+    return Response(json.dumps(report), status=200 if md_warmup.ready() else 503, mimetype='application/json')
+
+
 #Errorhandler
 @app.errorhandler(500)
 def server_error(e):
@@ -0,0 +1,108 @@
+"""Search latency benchmark against the configured Elasticsearch.
+
+Run from the repository root:  python -m benchmarks.bench_search [runs]
+
+Modes bypass the search cache: the baseline sequential cascade (full _source, should query
+without must_not), the cascade in one _msearch and the single boosted query.
+"""
+
+#Imports
+import sys
+import copy
+import time
+import statistics
+from collections import OrderedDict as od
+
+#Modules
+from modules.md_elasticsearch import Elastic
+
+
+#Representative guided searches, from narrow to broad
+searches = [
+    od([("meal", ["Main"]), ("time", ["Quick"]), ("difficulty", ["Easy"]), ("cuisine", ["Italian"]),
+        ("ingredient", ["Chicken", "Orange"]), ("special", ["Nut Free"]), ("occasion", []),
+        ("technique", []), ("avoid", ["Zucchini"])]),
+    od([("meal", ["Main"]), ("time", ["Long"]), ("difficulty", ["Normal"]), ("cuisine", ["Asian"]),
+        ("ingredient", ["Rice"]), ("special", [None]), ("occasion", []), ("technique", []), ("avoid", [])]),
+    od([("meal", ["Dessert"]), ("time", [None]), ("difficulty", [None]), ("cuisine", [None]),
+        ("ingredient", [None]), ("special", [None]), ("occasion", []), ("technique", []), ("avoid", [])]),
+]
+
+
+def baseline_query(query, bools, b=0):
+    
+    """Request body of the previous must/should queries"""
+    
+    return {"from": b, "size": 5, "query" : {"bool" : {query : bools}}}
+
+
+def cascade(state_dict):
+    
+    """Previous search path: must query, then a sequential should query"""
+    
+    elastic = Elastic()
+    elastic.hit_list = []
+    elastic.bools = elastic.build_query(state_dict)
+    elastic.run_search(baseline_query("must", elastic.bools, state_dict['search_batch']))
+    if len(elastic.hit_list) < 5:
+        elastic.run_search(baseline_query("should", elastic.bools, state_dict['search_batch']))
+    return elastic.hit_list
+
+
+def prepared(state_dict):
+    
+    elastic = Elastic()
+    elastic.hit_list = []
+    elastic.exact_match = True
+    elastic.bools = elastic.build_query(state_dict)
+    return elastic
+
+
+def msearch(state_dict):
+    
+    """RANKING "cascade": must and should query in one _msearch round trip"""
+    
+    elastic = prepared(state_dict)
+    elastic.cascade_search(5)
+    return elastic.hit_list
+
+
+def boosted(state_dict):
+    
+    """RANKING "boosted": one function_score query"""
+    
+    elastic = prepared(state_dict)
+    elastic.boosted_search(5)
+    return elastic.hit_list
+
+
+modes = od([("cascade", cascade), ("msearch", msearch), ("boosted", boosted)])
+
+
+def run(modes, runs):
+    
+    """Times each mode over all searches, returns latencies in ms per mode"""
+    
+    timings = od((name, []) for name in modes)
+    for _ in range(runs):
+        for params in searches:
+            for name, fn in modes.items():
+                state_dict = {'search-params': copy.deepcopy(params), 'search_batch': 0}
+                start = time.perf_counter()
+                fn(state_dict)
+                timings[name].append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(timings):
+    
+    for name, values in timings.items():
+        values = sorted(values)
+        print("{:<10} n={:<5} mean={:7.2f}ms p50={:7.2f}ms p95={:7.2f}ms".format(
+            name, len(values), statistics.mean(values), values[len(values)//2],
+            values[int(len(values)*0.95)]))
+
+
+if __name__ == '__main__':
+    
+    report(run(modes, int(sys.argv[1]) if len(sys.argv) > 1 else 50))
@@ -0,0 +1,55 @@
+"""Session encoding benchmark: pickle vs. the hash fields of md_redis, one JSON value per field.
+
+Run from the repository root:  python -m benchmarks.bench_session
+"""
+
+#Imports
+import pickle
+import timeit
+from collections import OrderedDict as od
+
+#Modules
+from modules.md_redis import flatten, unflatten, Session
+
+
+params = od([("meal", ["Main"]), ("time", ["Long", "Standard"]), ("difficulty", [None]),
+             ("cuisine", ["Italian"]), ("ingredient", ["Chicken", "Tomato"]), ("special", [None]),
+             ("occasion", []), ("technique", []), ("avoid", ["Zucchini"])])
+
+#result window entries are [_id, exact]
+hits = [['AWk{:016d}'.format(i), i < 12] for i in range(20)]
+
+sessions = od([
+    ("prompting", od([('search-params', params), ('stage', 'cuisine')])),
+    ("results", od([('search-params', params), ('stage', 'completed-yes'), ('search_batch', 5),
+                    ('search_window', {'key': 'a'*40, 'start': 0, 'hits': hits, 'more': True,
+                                       'cursor': {'must': [7.2, hits[-1][0]], 'should': None}}),
+                    ('search_results', [hit[0] for hit in hits[5:10]])])),
+])
+#fields read by a turn, paging reads the window only
+sessions["turn"] = od((k, v) for k,v in sessions["results"].items() if k != 'search_window')
+sessions["window"] = od([('search_window', sessions["results"]['search_window'])])
+
+
+def hash_fields(state):
+    return list(flatten(state).items())
+
+def read_fields(items):
+    return unflatten(items, Session())
+
+
+def report(number=5000):
+    
+    for name, state in sessions.items():
+        for codec, dumps, loads in [("pickle", pickle.dumps, pickle.loads),
+                                    ("hash", hash_fields, read_fields)]:
+            data = dumps(state)
+            size = len(data) if codec == "pickle" else sum(len(v) for _, v in data)
+            seconds = min(timeit.repeat(lambda: loads(data), number=number, repeat=5))
+            print("{:<10} {:<8} {:6d} bytes  decode {:6.1f}us".format(
+                name, codec, size, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    
+    report()
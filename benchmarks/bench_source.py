@@ -0,0 +1,51 @@
+"""Response size benchmark: full _source vs. the fields used by the result carousel.
+
+Run from the repository root:  python -m benchmarks.bench_source [runs]
+"""
+
+#Imports
+import sys
+import copy
+import json
+import time
+import urllib.request
+
+#Modules
+from modules.md_elasticsearch import Elastic, elastic_host
+from benchmarks.bench_search import searches
+
+
+def fetch(body):
+    
+    """Returns raw response bytes of a search"""
+    
+    req = urllib.request.Request("http://{}:9200/recipes/recipe/_search".format(elastic_host),
+                                 data=json.dumps(body).encode("utf-8"),
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as res:
+        return res.read()
+
+
+def report(runs=20):
+    
+    for full in [True, False]:
+        sizes, decode = [], []
+        for _ in range(runs):
+            for params in searches:
+                elastic = Elastic()
+                elastic.bools = elastic.build_query({'search-params': copy.deepcopy(params)})
+                body = elastic.must_query(0, 20)
+                if full:
+                    del body["_source"]
+                data = fetch(body)
+                start = time.perf_counter()
+                json.loads(data.decode("utf-8"))
+                decode.append((time.perf_counter() - start) * 1e6)
+                sizes.append(len(data))
+        print("{:<9} {:8.0f} bytes/search  decode {:7.1f}us".format(
+            "full" if full else "filtered", sum(sizes) / len(sizes), sum(decode) / len(decode)))
+
+
+if __name__ == '__main__':
+    
+    report(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,55 @@
+"""Cold start benchmark: time and memory to import app.py in a fresh interpreter.
+
+Run from the repository root:  python -m benchmarks.bench_startup [runs]
+
+Each run starts a new process, imports app, then creates the search client, which is
+deferred until the first request that needs it. Also lists which heavy packages the
+import pulled in.
+"""
+
+#Imports
+import sys
+import json
+import statistics
+import subprocess
+
+heavy_modules = ["dialogflow", "grpc", "google.api_core", "google.oauth2", "google.protobuf", "elasticsearch", "redis"]
+
+child = """
+import sys, json, time, resource
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+loaded = [m for m in {modules!r} if m in sys.modules]
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+from modules.md_elasticsearch import es
+es.resolve()
+print(json.dumps({{"import_ms": (imported - start) * 1000, "search_ms": (time.perf_counter() - imported) * 1000,
+                  "rss_kb": rss_kb, "loaded": loaded}}))
+""".format(modules=heavy_modules)
+
+
+def run(runs=10):
+
+    """Returns one measurement dict per fresh interpreter"""
+
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", child], stdout=subprocess.PIPE, check=True)
+        results.append(json.loads(out.stdout.decode("utf-8").strip().splitlines()[-1]))
+    return results
+
+
+def report(results):
+
+    for key in ["import_ms", "search_ms"]:
+        values = sorted(r[key] for r in results)
+        print("{:<10} n={:<3} mean={:8.1f}ms p50={:8.1f}ms max={:8.1f}ms".format(
+            key, len(values), statistics.mean(values), values[len(values)//2], values[-1]))
+    print("peak rss after import: {:.1f} MiB".format(statistics.mean(r["rss_kb"] for r in results) / 1024))
+    print("imported at startup: {}".format(", ".join(results[0]["loaded"]) or "-"))
+
+
+if __name__ == '__main__':
+
+    report(run(int(sys.argv[1]) if len(sys.argv) > 1 else 10))
@@ -0,0 +1,160 @@
+"""Webhook throughput benchmark: concurrent conversations against a running server.
+
+Start a Graph API sink and a server pointing at it (`"GRAPH_URL": "http://127.0.0.1:8090"`
+in config/keys.json), e.g.
+
+    gunicorn -b :8080 app:app
+
+then run from the repository root:  python -m benchmarks.bench_webhook [url] [conversations] [turns]
+A turn counts from the webhook POST until the sink received the first reply to that sender.
+"""
+
+#Imports
+import sys
+import json
+import time
+import threading
+import statistics
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+#Guided search conversation, repeated if more turns are requested,
+#("postback", payload) entries press a button instead of sending text
+script = ["Restart", "Guided search", "Dinner", "Quick", "Easy", "Italian", "Chicken",
+          "Doesn't matter", "Load more"]
+
+
+class Sink:
+
+    """Counts Send API messages per recipient"""
+
+    def __init__(self):
+
+        self.counts = {}
+        self.cond = threading.Condition()
+
+
+    def received(self, recipient_id):
+
+        with self.cond:
+            self.counts[recipient_id] = self.counts.get(recipient_id, 0) + 1
+            self.cond.notify_all()
+
+
+    def wait(self, recipient_id, seen, timeout=30):
+
+        """Blocks until recipient got more than seen messages, returns False on timeout"""
+
+        with self.cond:
+            return self.cond.wait_for(lambda: self.counts.get(recipient_id, 0) > seen, timeout)
+
+
+    def count(self, recipient_id):
+
+        with self.cond:
+            return self.counts.get(recipient_id, 0)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve_sink(sink, port=8090, delay=0):
+
+    """Runs a Graph API stand-in answering every post like the Send API after delay seconds"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode("utf-8"))
+            if delay:
+                time.sleep(delay)
+            answer = json.dumps({"recipient_id": body["recipient"]["id"], "message_id": "mid"}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+            sink.received(body["recipient"]["id"])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingServer(("127.0.0.1", port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def post_event(url, sender_id, text):
+
+    event = {"sender": {"id": sender_id}, "recipient": {"id": "page"}, "timestamp": int(time.time() * 1000)}
+    if isinstance(text, tuple):
+        event["postback"] = {"title": text[1], "payload": text[1]}
+    else:
+        event["message"] = {"mid": "mid", "text": text, "quick_reply": {"payload": text}}
+    payload = {"object": "page", "entry": [{"id": "page", "time": event["timestamp"], "messaging": [event]}]}
+    req = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=60) as res:
+        res.read()
+
+
+def converse(url, sink, sender_id, turns, latencies, failures, script=script):
+
+    for i in range(turns):
+        seen = sink.count(sender_id)
+        start = time.perf_counter()
+        try:
+            post_event(url, sender_id, script[i % len(script)])
+        except urllib.error.URLError:
+            failures.append(sender_id)
+            continue
+        if sink.wait(sender_id, seen):
+            latencies.append((time.perf_counter() - start) * 1000)
+        else:
+            failures.append(sender_id)
+
+
+def run(url, conversations=100, turns=9, sink=None, script=script):
+
+    """Drives concurrent conversations, returns (turn latencies in ms, failed turns, seconds)"""
+
+    sink = sink or Sink()
+    latencies, failures = [], []
+    threads = [threading.Thread(target=converse, args=(url, sink, "bench-{}".format(i), turns,
+                                                       latencies, failures, script))
+               for i in range(conversations)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, failures, time.perf_counter() - start
+
+
+def report(latencies, failures, elapsed):
+
+    values = sorted(latencies)
+    print("turns={} failed={} {:.1f} turns/s".format(len(values), len(failures), len(values) / elapsed))
+    if values:
+        print("mean={:7.1f}ms p50={:7.1f}ms p95={:7.1f}ms p99={:7.1f}ms".format(
+            statistics.mean(values), values[len(values)//2], values[int(len(values)*0.95)],
+            values[int(len(values)*0.99)]))
+
+
+if __name__ == '__main__':
+
+    url = sys.argv[1] if len(sys.argv) > 1 else "http://127.0.0.1:8080/webhook"
+    sink = Sink()
+    serve_sink(sink)
+    report(*run(url, int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+                int(sys.argv[3]) if len(sys.argv) > 3 else len(script), sink))
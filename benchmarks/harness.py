@@ -0,0 +1,226 @@
+"""End-to-end benchmark of app.py against local stand-ins for all external services.
+
+- Graph API: the sink of bench_webhook, answering after --graph-ms
+- Dialogflow: a scripted sessions client resolving the phrases of data/fastpath.json after --dialogflow-ms
+- Elasticsearch: the local search backend loaded with --recipes synthetic recipes, details from a detail store
+- Redis: fakeredis, or a real server with --redis host
+
+The harness writes its own config/keys.json into a temporary working directory, no
+credentials are needed. Run from the repository root:
+
+    python -m benchmarks.harness [--conversations 50] [--rounds 2] [--async] [--no-fastpath]
+"""
+
+#Imports
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from collections import OrderedDict as od
+
+#Modules
+from benchmarks.bench_webhook import Sink, serve_sink, run, report
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Guided search with a details button, as in a typical session
+script = ["Hi", "Restart", "Lunch/Dinner", "Quick", "Easy", "Italian", "Chicken", "None",
+          "Yes", "Load more", ("postback", "SHOW_INGREDIENT_0"), ("postback", "SHOW_NUTRIENT_1")]
+
+specials = ["Vegan", "Vegetarian", "Healthy", "Nut Free", "Gluten Free", "Dairy Free"]
+
+
+def synthetic_recipes(count, seed=0):
+
+    """Yields snapshot documents with categories drawn from the fast path vocabulary"""
+
+    with open(os.path.join(root, "data", "fastpath.json")) as f:
+        phrases = json.load(f)
+    vocabulary = od()
+    for entry in phrases.values():
+        for k,vals in entry.get("params", {}).items():
+            vocabulary.setdefault(k, set()).update(vals)
+    vocabulary = od((k, sorted(v)) for k,v in vocabulary.items())
+
+    rng = random.Random(seed)
+    for i in range(count):
+        categories = {k: rng.sample(vals, 1) for k,vals in vocabulary.items() if k != "ingredient"}
+        categories["ingredient"] = rng.sample(vocabulary["ingredient"], rng.randint(1, 3))
+        categories["special"] = rng.sample(specials, rng.randint(0, 2))
+        yield {"_id": "recipe-{}".format(i), "_source": {
+            "_recipe_id": i, "title": "Recipe {}".format(i), "url": "https://example.com/recipe/{}".format(i),
+            "image_link": None if i % 4 == 0 else "https://example.com/img/{}.jpg".format(i),
+            "rating": rng.choice([None, 2.5, 3, 3.5, 4]), "recomm_perc": rng.randint(50, 100),
+            "servings": str(rng.randint(1, 8)),
+            "ingredients": [{"ingredient_group": "Main",
+                             "ingredient_group_content": ["{} g {}".format(rng.randint(10, 500), v)
+                                                          for v in categories["ingredient"]]}],
+            "nutrients": {"calories": rng.randint(100, 900), "fat": rng.randint(1, 60),
+                          "protein": rng.randint(1, 50), "carbohydrates": rng.randint(5, 120)},
+            "categories": categories}}
+
+
+class ScriptedSessionsClient:
+
+    """Dialogflow stand-in, answers known phrases with their intent and parameters"""
+
+    def __init__(self, phrases, delay=0):
+
+        from google.protobuf.struct_pb2 import Struct
+
+        self.delay = delay
+        self.results = {}
+        for phrase, entry in phrases.items():
+            params = Struct()
+            params.update(entry.get("params", {}))
+            self.results[phrase.lower()] = (entry["intent"], params)
+        welcome = Struct()
+        self.results["hi"] = ("default-welcome-intent", welcome)
+        self.fallback = ("default-fallback-intent", Struct())
+
+
+    def session_path(self, project, session):
+        return "projects/{}/agent/sessions/{}".format(project, session)
+
+
+    def detect_intent(self, session, query_input):
+
+        if self.delay:
+            time.sleep(self.delay)
+        intent, params = self.results.get(query_input.text.text.lower(), self.fallback)
+        return Response(QueryResult(intent, params))
+
+
+
+class QueryResult:
+
+    def __init__(self, intent, params):
+
+        self.intent = Intent(intent)
+        self.parameters = params
+        self.fulfillment_text = "Scripted answer for {}.".format(intent)
+
+
+class Intent:
+
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class Response:
+
+    def __init__(self, query_result):
+        self.query_result = query_result
+
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def boot(args):
+
+    """Prepares the working directory and imports app.py against the stand-ins"""
+
+    workdir = tempfile.mkdtemp(prefix="harness-")
+    os.makedirs(os.path.join(workdir, "config"))
+    os.symlink(os.path.join(root, "data"), os.path.join(workdir, "data"))
+
+    snapshot = os.path.join(workdir, "recipes.jsonl.gz")
+    with gzip.open(snapshot, "wt", encoding="utf-8") as f:
+        for doc in synthetic_recipes(args.recipes):
+            f.write(json.dumps(doc) + "\n")
+
+    keys = {"FLASK_SECRET_KEY": "harness", "FB_ACCESS_TOKEN": "harness", "FB_VERIFY_TOKEN": "harness",
+            "DIALOGFLOW_PROJECT_ID": "harness", "REDIS_HOST": args.redis or "localhost",
+            "ELASTIC_HOST": "localhost", "SEARCH_BACKEND": "local", "LOCAL_SEARCH_SNAPSHOT": snapshot,
+            "GRAPH_URL": "http://127.0.0.1:{}".format(args.sink_port), "METRICS": True,
+            "ASYNC_WEBHOOK": args.async_webhook}
+    keys.update(json.loads(args.keys))
+    with open(os.path.join(workdir, "config", "keys.json"), "w") as f:
+        json.dump(keys, f)
+
+    os.chdir(workdir)
+    sys.path.insert(0, root)
+
+    from modules import md_redis
+    if not args.redis:
+        import fakeredis
+        md_redis.r.override(fakeredis.FakeStrictRedis())
+    else:
+        md_redis.r.flushdb()
+
+    #local search keeps no ingredients or nutrients, details come from a detail store
+    from modules import md_elasticsearch
+    from modules.md_detail_store import DetailStore, build
+    store = os.path.join(workdir, "recipe_details.bin")
+    build(((doc["_id"], doc["_source"]) for doc in synthetic_recipes(args.recipes)),
+          md_elasticsearch.Elastic().render_details, store)
+    md_elasticsearch.detail_store = DetailStore(store)
+
+    from modules import md_dialogflow
+    from modules.md_fastpath import fastpath, phrases
+    md_dialogflow.sessions.factory = lambda: (ScriptedSessionsClient(phrases, args.dialogflow_ms / 1000), None)
+    if args.no_fastpath:
+        fastpath.table = {}
+
+    import app
+    return app
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against local stand-ins")
+    parser.add_argument("--conversations", type=int, default=50, help="concurrent conversations")
+    parser.add_argument("--rounds", type=int, default=1, help="repetitions of the script per conversation")
+    parser.add_argument("--recipes", type=int, default=5000, help="synthetic recipes in the search backend")
+    parser.add_argument("--dialogflow-ms", type=float, default=80, help="simulated detect_intent latency")
+    parser.add_argument("--graph-ms", type=float, default=40, help="simulated Send API latency")
+    parser.add_argument("--redis", help="Redis host to use instead of fakeredis, its database is flushed")
+    parser.add_argument("--async", dest="async_webhook", action="store_true", help="set ASYNC_WEBHOOK")
+    parser.add_argument("--no-fastpath", action="store_true", help="send every message to Dialogflow")
+    parser.add_argument("--keys", default="{}", help="JSON object of extra config keys")
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--sink-port", type=int, default=8090)
+    args = parser.parse_args(argv)
+
+    sink = Sink()
+    serve_sink(sink, args.sink_port, args.graph_ms / 1000)
+    app = boot(args)
+
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    from modules.md_metrics import metrics
+
+    samples = od()
+    lock = threading.Lock()
+    def observe(stage, intent, seconds):
+        with lock:
+            samples.setdefault(stage, []).append(seconds * 1000)
+    metrics.observers.append(observe)
+
+    server = make_server("127.0.0.1", args.port, app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    url = "http://127.0.0.1:{}/webhook".format(args.port)
+    report(*run(url, args.conversations, args.rounds * len(script), sink, script))
+
+    print("{:<12} {:>7} {:>9} {:>9} {:>9}".format("stage", "n", "p50", "p95", "p99"))
+    for stage, values in samples.items():
+        values = sorted(values)
+        print("{:<12} {:>7} {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms".format(
+            stage, len(values), percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99)))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+
+    main()
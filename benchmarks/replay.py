@@ -0,0 +1,193 @@
+"""Replays captured conversations offline, reports turn latency and behavioral diffs.
+
+Record a trace by setting "CAPTURE_PATH" in config/keys.json, then run from the repository root:
+
+    python -m benchmarks.replay trace.jsonl [--runs 3] [--redis]
+
+Every turn starts from its recorded session and gets its recorded Dialogflow answer. Searches
+use the backend configured in config/keys.json, sessions live in fakeredis unless --redis is
+given (its sessions of the replayed users are overwritten). Stage, search params (entity values
+unordered), batch and result ids of the session after the turn and the structure of the replies
+(kind, number of quick replies, carousel titles) are compared with the trace; texts and
+quick-reply choices are not, both are picked at random.
+"""
+
+#Imports
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict as od
+from flask import Flask
+from google.protobuf.struct_pb2 import Struct
+
+#Modules
+from benchmarks.harness import QueryResult, percentile
+from modules.md_capture import outcome_fields
+
+
+def normalize(value):
+    return json.loads(json.dumps(value, default=list))
+
+
+def comparable(field, value):
+
+    """Normalized outcome field, entity values come from sets and are compared unordered"""
+
+    value = normalize(value)
+    if field == "search-params" and value:
+        return {k: sorted(v, key=str) if isinstance(v, list) else v for k,v in value.items()}
+    return value
+
+
+def reply_shape(payload):
+
+    """Reply structure that does not depend on randomly chosen prompts and quick replies"""
+
+    shape = {'quick_replies': len(payload.get('quick_replies') or [])}
+    attachment = payload.get('attachment')
+    if attachment:
+        shape['elements'] = [e.get('title') for e in attachment.get('payload', {}).get('elements', [])]
+    else:
+        shape['text'] = bool(payload.get('text'))
+    return shape
+
+
+class ReplayClient:
+
+    """Send API stand-in collecting the replies of a turn"""
+
+    def __init__(self):
+        self.replies = []
+
+    def send(self, payload, entry, messaging_type, **kwargs):
+        self.replies.append(payload)
+        return {}
+
+    def send_action(self, sender_action, entry, **kwargs):
+        return {}
+
+
+
+class Replayer:
+
+    def __init__(self, use_redis=False):
+
+        from modules import md_redis, md_dialogflow, md_capture
+        from modules.md_messenger import Messenger
+
+        md_capture.recorder.path = None
+        if not use_redis:
+            import fakeredis
+            md_redis.r.override(fakeredis.FakeStrictRedis())
+        self.redis = md_redis
+
+        self.answer = None
+        md_dialogflow.query_dialogflow = self.query_dialogflow
+
+        self.app = Flask("replay")
+        self.client = ReplayClient()
+        self.messenger = Messenger("replay", workers=1)
+        self.messenger.client = self.client
+
+
+    def query_dialogflow(self, session_id, text):
+
+        """Returns the recorded Dialogflow answer of the current turn"""
+
+        if self.answer is None:
+            raise LookupError("No recorded Dialogflow answer for {!r}".format(text))
+        params = Struct()
+        params.update(self.answer['params'])
+        result = QueryResult(self.answer['intent'], params)
+        result.fulfillment_text = self.answer['fulfillment_text']
+        return result
+
+
+    def turn(self, record):
+
+        """Replays one record, returns (ms, diffs)"""
+
+        from fbmessenger import BaseMessenger
+
+        event = record['event']
+        user_id = event['sender']['id']
+        self.redis.redis_delete(user_id)
+        if record['before']:
+            self.redis.redis_set(user_id, record['before'])
+        self.answer = record['dialogflow']
+        self.client.replies = []
+
+        diffs = []
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                BaseMessenger.handle(self.messenger, {'entry': [{'messaging': [event]}]})
+        except Exception as e:
+            diffs.append(("error", None, repr(e)))
+        ms = (time.perf_counter() - start) * 1000
+
+        after = normalize(self.redis.redis_get(user_id) or {})
+        recorded = record['after'] or {}
+        for field in outcome_fields:
+            if comparable(field, recorded.get(field)) != comparable(field, after.get(field)):
+                diffs.append((field, recorded.get(field), after.get(field)))
+        shapes = [reply_shape(p) for p in normalize(self.client.replies)]
+        recorded_shapes = [reply_shape(p) for p in record['replies']]
+        if shapes != recorded_shapes:
+            diffs.append(("replies", recorded_shapes, shapes))
+        return ms, diffs
+
+
+
+def label(record):
+
+    if record['dialogflow']:
+        return record['dialogflow']['intent']
+    return "postback" if 'postback' in record['event'] else "fastpath"
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Replays a captured trace offline")
+    parser.add_argument("trace")
+    parser.add_argument("--runs", type=int, default=1, help="replays of the whole trace, diffs are taken from the first")
+    parser.add_argument("--redis", action="store_true", help="use the configured Redis instead of fakeredis")
+    args = parser.parse_args(argv)
+
+    from modules.md_capture import read_trace
+    records = list(read_trace(args.trace))
+    replayer = Replayer(args.redis)
+
+    timings = od()
+    diffs = []
+    start = time.perf_counter()
+    for run in range(args.runs):
+        for line, record in enumerate(records, 1):
+            ms, turn_diffs = replayer.turn(record)
+            timings.setdefault(label(record), []).append(ms)
+            if run == 0:
+                diffs += [(line,) + diff for diff in turn_diffs]
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(v) for v in timings.values())
+    print("turns={} {:.1f} turns/s".format(total, total / elapsed))
+    print("{:<32} {:>6} {:>9} {:>9} {:>9} {:>9}".format("intent", "n", "p50", "p95", "p99", "recorded"))
+    recorded = od()
+    for record in records:
+        recorded.setdefault(label(record), []).append(record['ms'])
+    for name, values in sorted(timings.items(), key=lambda t: -len(t[1])):
+        values = sorted(values)
+        print("{:<32} {:>6} {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms".format(
+            name, len(values), percentile(values, 0.5), percentile(values, 0.95),
+            percentile(values, 0.99), percentile(sorted(recorded[name]), 0.5)))
+
+    for line, field, expected, actual in diffs[:20]:
+        print("line {} {}: recorded {} | replayed {}".format(line, field, json.dumps(expected), json.dumps(actual)))
+    print("{} behavioral diffs in {} turns".format(len(diffs), len(records)))
+    return 1 if diffs else 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,36 @@
+#Gunicorn settings, used by the entrypoint in app.yaml
+
+#Imports
+import sys
+
+#Seconds a silent worker is given before the master restarts it, and to finish when stopped
+timeout = 30
+graceful_timeout = 30
+
+
+def post_fork(server, worker):
+
+    """Opens Redis, search and Dialogflow connections in the background once the worker is forked
+
+    Connections and mmaps must not be shared across fork, so every worker warms up itself.
+    The worker answers /warmup with 503 until all steps succeeded, so it gets no traffic before.
+    """
+
+    from modules.md_warmup import start
+
+    def log(report):
+        failed = [name for name, step in report.items() if not step['ok']]
+        server.log.info("Worker {} warmed up in {:.0f}ms{}".format(
+            worker.pid, sum(step['ms'] for step in report.values()),
+            ", failed: " + ", ".join(failed) if failed else ""))
+
+    start(log)
+
+
+def worker_exit(server, worker):
+
+    """Processes the webhook events still queued with ASYNC_WEBHOOK before the worker exits"""
+
+    app = sys.modules.get("app")
+    if app is not None and not app.work_queue.close(app.keys.get('WEBHOOK_DRAIN_TIMEOUT', 20)):
+        server.log.warning("Worker {} exited with unprocessed webhook events".format(worker.pid))
@@ -0,0 +1,149 @@
+#Imports
+import json
+import time
+import threading
+from collections import OrderedDict as od
+
+
+class LRUCache:
+
+    def __init__(self, maxsize=1024, ttl=600, max_weight=None, weigh=None):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh or (lambda value: 1)
+        self.weight = 0
+        self.data = od()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+
+        """Returns cached value or None, expired entries count as misses"""
+
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self.pop(key)
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+
+    def peek(self, key):
+
+        """Returns current value without counting or reordering"""
+
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+
+    def set(self, key, value, ttl=None):
+
+        """Stores value, evicts least recently used entries above maxsize or max_weight"""
+
+        with self.lock:
+            self.pop(key)
+            weight = self.weigh(value)
+            expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self.data[key] = (expires, value, weight)
+            self.weight += weight
+            while len(self.data) > self.maxsize or (self.max_weight and self.weight > self.max_weight):
+                self.pop(next(iter(self.data)))
+
+
+    def pop(self, key):
+
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+
+    def delete(self, key):
+
+        with self.lock:
+            self.pop(key)
+
+
+    def invalidate(self):
+
+        """Drops all entries, e.g. after the index was reloaded"""
+
+        with self.lock:
+            self.data.clear()
+            self.weight = 0
+
+
+    def stats(self):
+
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'weight': self.weight}
+
+
+
+class RedisCache:
+
+    def __init__(self, client, prefix, ttl=600):
+
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+
+        """Returns cached value or None, shared by all processes"""
+
+        res = self.client.get("{}:{}".format(self.prefix, key))
+        with self.lock:
+            if res is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(res.decode("utf-8"))
+
+
+    def set(self, key, value):
+
+        """Stores value with TTL, size is bounded by Redis' maxmemory policy"""
+
+        self.client.set("{}:{}".format(self.prefix, key),
+                        json.dumps(value, separators=(',', ':')), ex=self.ttl)
+
+
+    def invalidate(self):
+
+        """Drops all entries of this cache for all processes"""
+
+        keys = list(self.client.scan_iter(match="{}:*".format(self.prefix), count=500))
+        for i in range(0, len(keys), 500):
+            self.client.delete(*keys[i:i+500])
+
+
+    def stats(self):
+
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+
+def make_cache(backend, prefix, maxsize=1024, ttl=600):
+
+    """Returns cache for configured backend ("local", "redis"), None if disabled"""
+
+    if backend == "local":
+        return LRUCache(maxsize, ttl)
+    elif backend == "redis":
+        from .md_redis import r
+        return RedisCache(r, prefix, ttl)
+    return None
@@ -0,0 +1,143 @@
+#Imports
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+
+#Modules
+from .md_config import keys
+from .md_redis import r, make_session, version_field
+
+
+#Session fields kept after a turn, replays compare them
+outcome_fields = ("stage", "search-params", "search_batch", "search_results")
+
+
+def anonymize(user_id):
+    return hashlib.sha1(str(user_id).encode("utf-8")).hexdigest()[:16]
+
+
+class Recorder:
+
+    """Appends one JSON line per handled event to a trace
+
+    A line holds the event with an anonymized sender, the Dialogflow answer (null when
+    the fast path resolved the message), the session before the turn, its outcome fields
+    after the turn and the payloads sent back. Lines are written with a single append,
+    so several gunicorn workers can share one trace file.
+    """
+
+    def __init__(self, path=None):
+
+        self.path = path
+        self.fd = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+    def snapshot(self, user_id):
+
+        """Returns the stored session as plain data, bypassing caches and metrics"""
+
+        try:
+            items = [(f.decode("utf-8"), v) for f,v in r.hgetall(user_id).items()
+                     if f.decode("utf-8") != version_field]
+        except Exception:
+            return None
+        return dict(make_session(items)) if items else None
+
+
+    @contextmanager
+    def turn(self, event):
+
+        user_id = event['sender']['id']
+        before = self.snapshot(user_id)
+        self.local.record = {'event': dict(event, sender={'id': anonymize(user_id)}),
+                             'dialogflow': None, 'replies': []}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record, self.local.record = self.local.record, None
+            record['ms'] = round((time.perf_counter() - start) * 1000, 2)
+            record['before'] = before
+            after = self.snapshot(user_id)
+            record['after'] = after and {k: after[k] for k in outcome_fields if k in after}
+            self.write(record)
+
+
+    def dialogflow(self, query_result):
+
+        record = getattr(self.local, 'record', None)
+        if record is not None:
+            from google.protobuf.json_format import MessageToDict
+            record['dialogflow'] = {'intent': query_result.intent.display_name,
+                                    'fulfillment_text': query_result.fulfillment_text,
+                                    'params': MessageToDict(query_result.parameters)}
+
+
+    def reply(self, payload):
+
+        record = getattr(self.local, 'record', None)
+        if record is not None:
+            record['replies'].append(payload)
+
+
+    def write(self, record):
+
+        line = (json.dumps(record, separators=(',', ':'), default=list) + "\n").encode("utf-8")
+        with self.lock:
+            if self.pid != os.getpid():
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                self.pid = os.getpid()
+            os.write(self.fd, line)
+
+
+recorder = Recorder(keys.get('CAPTURE_PATH'))
+
+
+
+################# Hooks ##########################
+
+class NullCapture:
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+null_capture = NullCapture()
+
+
+def capture(event):
+
+    """Records the turn handling event when CAPTURE_PATH is set"""
+
+    if recorder.path and 'sender' in event:
+        return recorder.turn(event)
+    return null_capture
+
+
+def capture_dialogflow(query_result):
+    if recorder.path:
+        recorder.dialogflow(query_result)
+
+
+def capture_reply(payload):
+    if recorder.path:
+        recorder.reply(payload)
+
+
+
+def read_trace(path):
+
+    """Yields the records of a trace"""
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
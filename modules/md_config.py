@@ -0,0 +1,57 @@
+#Imports
+import json
+import threading
+
+files = {}
+files_lock = threading.Lock()
+
+
+def load(path):
+
+    """Returns the parsed JSON file, each file is read once per process"""
+
+    with files_lock:
+        if path not in files:
+            with open(path, "r") as f:
+                files[path] = json.load(f)
+        return files[path]
+
+
+#Keys
+keys = load("config/keys.json")
+
+
+class Lazy:
+
+    """Creates a client on first use and forwards attribute access to it
+
+    Importing a module that holds a client then costs nothing, connections, snapshots and
+    credentials are only set up by the first request that needs them.
+    """
+
+    def __init__(self, factory):
+
+        self.factory = factory
+        self.instance = None
+        self.lock = threading.Lock()
+
+
+    def resolve(self):
+
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    self.instance = self.factory()
+        return self.instance
+
+
+    def override(self, instance):
+
+        """Replaces the client, e.g. by a stand-in in benchmarks"""
+
+        with self.lock:
+            self.instance = instance
+
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
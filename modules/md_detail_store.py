@@ -0,0 +1,133 @@
+#Imports
+import os
+import sys
+import mmap
+import struct
+import hashlib
+
+#File layout: header, index of (id hash, offset) sorted by hash, records
+#record: id length (H), id, ingredients length (I), ingredients, nutrients length (I), nutrients
+magic = b'EPIDTL1\0'
+header = struct.Struct('>8sI4x')
+index_entry = struct.Struct('>QQ')
+id_length = struct.Struct('>H')
+text_length = struct.Struct('>I')
+
+
+def id_hash(recipe_id):
+    return int.from_bytes(hashlib.blake2b(recipe_id.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class DetailStore:
+
+    """Read-only, memory-mapped ingredient and nutrient texts indexed by recipe _id
+
+    All gunicorn workers map the same file, so its pages live once in the page cache.
+    """
+
+    def __init__(self, path):
+
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        file_magic, self.count = header.unpack_from(self.mm, 0)
+        if file_magic != magic:
+            raise ValueError("{} is not a recipe detail store".format(path))
+
+
+    def find(self, recipe_id):
+
+        """Returns record offset for recipe_id, None if missing"""
+
+        target = id_hash(recipe_id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if index_entry.unpack_from(self.mm, header.size + mid * index_entry.size)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        #equal hashes are adjacent, compare ids
+        encoded = recipe_id.encode("utf-8")
+        while lo < self.count:
+            entry_hash, offset = index_entry.unpack_from(self.mm, header.size + lo * index_entry.size)
+            if entry_hash != target:
+                return None
+            length = id_length.unpack_from(self.mm, offset)[0]
+            start = offset + id_length.size
+            if self.view[start:start+length] == encoded:
+                return start + length
+            lo += 1
+        return None
+
+
+    def get(self, recipe_id, field):
+
+        """Returns pre-rendered "ingredients" or "nutrients" text, None if missing"""
+
+        offset = self.find(recipe_id)
+        if offset is None:
+            return None
+        if field == "nutrients":
+            offset += text_length.size + text_length.unpack_from(self.mm, offset)[0]
+        length = text_length.unpack_from(self.mm, offset)[0]
+        start = offset + text_length.size
+        return str(self.view[start:start+length], "utf-8")
+
+
+    def warm(self):
+
+        """Touches every page so the first lookups do not fault them in from disk"""
+
+        if hasattr(self.mm, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+            self.mm.madvise(mmap.MADV_WILLNEED)
+        step = mmap.PAGESIZE
+        return sum(self.mm[i] for i in range(0, len(self.mm), step))
+
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+
+
+def build(docs, render, path):
+
+    """Writes pre-rendered details of (recipe_id, source) docs, render(source, field) returns text"""
+
+    records = []
+    for recipe_id, source in docs:
+        encoded = recipe_id.encode("utf-8")
+        record = id_length.pack(len(encoded)) + encoded
+        for field in ["ingredients", "nutrients"]:
+            text = render(source, field).encode("utf-8")
+            record += text_length.pack(len(text)) + text
+        records.append((id_hash(recipe_id), record))
+    records.sort(key=lambda r: r[0])
+
+    offset = header.size + len(records) * index_entry.size
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.pack(magic, len(records)))
+        for entry_hash, record in records:
+            f.write(index_entry.pack(entry_hash, offset))
+            offset += len(record)
+        for _, record in records:
+            f.write(record)
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+if __name__ == '__main__':
+
+    #python -m modules.md_detail_store [snapshot] [store], run after each index update
+    import json
+    from .md_local_search import open_snapshot
+    from .md_elasticsearch import Elastic, keys
+
+    snapshot = sys.argv[1] if len(sys.argv) > 1 else keys.get('LOCAL_SEARCH_SNAPSHOT', "data/recipes.jsonl.gz")
+    path = sys.argv[2] if len(sys.argv) > 2 else keys.get('DETAIL_STORE', "data/recipe_details.bin")
+    with open_snapshot(snapshot) as f:
+        docs = ((doc["_id"], doc["_source"]) for doc in map(json.loads, f))
+        print("{} recipes written to {}".format(build(docs, Elastic().render_details, path), path))
@@ -1,12 +1,19 @@
 #Imports
 import random
 import json
+import logging
+import hashlib
 from collections import OrderedDict as od
+from elasticsearch import TransportError
 
 #Modules
+from .md_config import keys, load
 from .md_join import join
-from .md_redis import redis_get, redis_set, redis_delete
-from .md_elasticsearch import Elastic
+from .md_redis import redis_get, redis_set, redis_delete, redis_fill
+from .md_elasticsearch import Elastic, filter_values
+from .md_fastpath import fastpath
+
+logger = logging.getLogger(__name__)
 
 #Entities
 entities = od({"meal": "meals",
@@ -20,9 +27,19 @@ entities = od({"meal": "meals",
                "avoid": "avoid"
 })
 
+#Session fields read per turn, the result window is read when paging
+session_fields = ['search-params.{}'.format(e) for e in entities] + ['stage', 'search_batch', 'search_results']
+
 #Responses
-with open("data/responses.json", "r") as f:
-    responses = json.load(f)
+responses = load("data/responses.json")
+
+#Results per page, results fetched per round trip and cached with the session, results per search
+page_size = 5
+window_size = 20
+max_results = keys.get('MAX_RESULTS', 20)
+
+#Offer only quick replies that leave exact matches, counted by a terms aggregation
+facet_quick_replies = keys.get('FACET_QUICK_REPLIES', False)
     
 
 class Search:
@@ -80,7 +97,7 @@ class Search:
         
         """Retrieves previously expressed params and merges with current params"""
         
-        state_dict = redis_get(self.user_id)
+        state_dict = redis_get(self.user_id, session_fields)
         
         if state_dict:
             
@@ -141,8 +158,7 @@ class Search:
         for entity in entities.keys():
             if len(self.state_dict['search-params'][entity]) == 0:
                 undefined.append(entity)
-        print(undefined)
-        print(self.state_dict)
+        logger.debug('Undefined entities: {}'.format(undefined))
         return undefined
     
         
@@ -169,17 +185,23 @@ class Search:
                 prompt = prompts["text"+ext]
             
             #no specific order unless "difficulty" or "time"
+            qrs = prompts["quick-replies"]
+            offered = self.offered_labels(missing_entity, qrs + ["Lunch/Dinner"] if missing_entity == "meal" else qrs)
+            pick = lambda labels, k: random.sample(labels, min(k, len(labels)))
             if missing_entity in ["difficulty", "time"]:
-                labels = prompts["quick-replies"]
+                labels = [l for l in qrs if l in offered]
             else:
-                qrs = prompts["quick-replies"]
                 if missing_entity == "special":
-                    labels =  random.sample(qrs[1:5], 1) + random.sample(qrs[6:], 1) + qrs[:1]
+                    labels = (pick([l for l in qrs[1:5] if l in offered], 1) +
+                              pick([l for l in qrs[6:] if l in offered], 1) + qrs[:1])
                 else:
-                    labels = random.sample(qrs[1:], 3) + qrs[:1]
+                    labels = pick([l for l in qrs[1:] if l in offered], 3) + qrs[:1]
             
             #fix "main" in meal
-            prompt_qrpls = ["Lunch/Dinner"] + labels[:-1] if missing_entity == "meal" else labels
+            if missing_entity == "meal":
+                prompt_qrpls = (["Lunch/Dinner"] if "Lunch/Dinner" in offered else []) + labels[:-1]
+            else:
+                prompt_qrpls = labels
             prompt_text = random.choice(prompt).format(join(self.changed))
             
             return (prompt_text, prompt_qrpls, None)
@@ -192,6 +214,36 @@ class Search:
                     responses["search-complete"]["quick-replies"], None)
 
 
+    def offered_labels(self, entity, labels):
+        
+        """Returns the quick-reply labels for entity that still leave search results
+        
+        Labels are mapped to search values by the fast path table and counted with the values
+        the search filters by ("Long" includes "Standard"). Labels without values ("Doesn't
+        matter") or that do not filter ("Normal") are always offered, so are all labels
+        without FACET_QUICK_REPLIES.
+        """
+        
+        if not facet_quick_replies:
+            return labels
+        values = od()
+        for label in labels:
+            entry = fastpath.lookup(label)
+            if entry and entity in entry.get("params", {}):
+                vals = filter_values(list(entry["params"][entity]))
+                if vals is not None:
+                    values[label] = vals
+        if not values:
+            return labels
+        
+        try:
+            counts = Elastic().facets(self.state_dict, entity, sorted({v for vals in values.values() for v in vals}))
+        except TransportError:
+            logger.exception("Facet counts failed, offering all quick replies.")
+            return labels
+        return [l for l in labels if l not in values or any(counts.get(v) for v in values[l])]
+    
+    
     def check_and_respond(self, ext=""):
         
         """Check required entities and respond"""
@@ -200,17 +252,54 @@ class Search:
         return self.respond(ext)
     
         
+    def search_key(self):
+        
+        """Fingerprint of the search params, changes invalidate cached results"""
+        
+        params = {k: sorted(v, key=str) for k,v in self.state_dict['search-params'].items()}
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    
     def search(self):
         
-        """Pushes Search"""
+        """Pushes Search, pages are served from the cached result window
+        
+        The window holds [_id, exact] of the hits from search_batch on, the next window continues
+        at its cursor. Carousel fields of a page are looked up by _id.
+        """
         
         #Remove current search results
         self.state_dict['search_results'] = []
         
-        elastic_hits, elastic_exact = Elastic().search(self.state_dict)
+        if 'search_window' not in self.state_dict:
+            redis_fill(self.user_id, self.state_dict, ['search_window'])
+        window = self.state_dict.get('search_window')
+        b = self.state_dict['search_batch']
+        
+        #start over for new search params or when going back
+        if not window or window['key'] != self.search_key() or 'cursor' not in window or b < window['start']:
+            window = {'key': self.search_key(), 'start': 0, 'hits': [], 'cursor': None, 'more': True}
+        
+        #fetch the next window while the page runs past the cached hits
+        while b + page_size > window['start'] + len(window['hits']) and window['more']:
+            kept = window['hits'][max(0, b - window['start']):]
+            elastic = Elastic()
+            hits, _ = elastic.search(self.state_dict, size=window_size, cursor=window['cursor'])
+            window = {'key': window['key'], 'start': window['start'] + len(window['hits']) - len(kept),
+                      'hits': kept + [[hit.id, hit.exact] for hit in hits],
+                      'cursor': elastic.cursor, 'more': elastic.cursor is not None}
+        self.state_dict['search_window'] = window
+        
+        offset = b - window['start']
+        entries = window['hits'][offset:offset+page_size]
+        elastic_hits = Elastic().get_hits(entries) if entries else []
+        if not elastic_hits:
+            prompts = responses["no-more-results"]
+            return (random.choice(prompts['text']), prompts['quick-replies'], None)
+        elastic_exact = all(hit.exact for hit in elastic_hits)
         
         #Add search result ids to state_dict
-        self.state_dict['search_results'] = [hit['id'] for hit in elastic_hits]
+        self.state_dict['search_results'] = [hit.id for hit in elastic_hits]
         self.state_dict['stage'] = "completed-yes"
         redis_set(self.user_id, self.state_dict)
         
@@ -360,8 +449,8 @@ class Search:
                     
             #load
             elif self.intent == 'search-load-more':
-                self.state_dict['search_batch'] += 5
-                if self.state_dict['search_batch'] == 20:
+                self.state_dict['search_batch'] += page_size
+                if self.state_dict['search_batch'] >= max_results:
                     prompts = responses["no-more-results"]
                     return (random.choice(prompts['text']), prompts['quick-replies'], None)
                 else:
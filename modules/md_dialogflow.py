@@ -1,51 +1,186 @@
 #Imports
-import json
-import dialogflow
-from google.api_core.exceptions import InvalidArgument
-from google.oauth2.service_account import Credentials
+import os
+import time
+import logging
+import itertools
+import threading
 
 #Modules
+from .md_config import keys
 from .md_dialog_logic import Search
+from .md_fastpath import fastpath
+from .md_metrics import timed, tag
+from .md_capture import capture_dialogflow
 
-#Dialogflow parameter
-with open("config/keys.json") as f:
-    project_id = json.load(f)['DIALOGFLOW_PROJECT_ID']
+logger = logging.getLogger(__name__)
+
+#Dialogflow parameter, the dialogflow and google packages are imported on first use
+project_id = keys['DIALOGFLOW_PROJECT_ID']
 
 dialogflow_config_path = 'config/cooking-chatbot-f88b6ceeeb5e.json'
-credentials = Credentials.from_service_account_file(dialogflow_config_path)
 language_code = 'en'
 
+#gRPC channel options, keepalive pings keep idle channels from being dropped
+channel_options = [('grpc.keepalive_time_ms', keys.get('DIALOGFLOW_KEEPALIVE_MS', 30000)),
+                   ('grpc.keepalive_timeout_ms', 10000),
+                   ('grpc.keepalive_permit_without_calls', 1),
+                   ('grpc.http2.max_pings_without_data', 0)]
+
 
-def detect_intent_texts(user_id, text):
+class SessionsClientPool:
     
-    """Handles Dialogflow's intent detection and response generation"""
+    def __init__(self, size=2, factory=None):
+        
+        self.size = size
+        self.factory = factory or self.create_client
+        self.credentials = None
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.pid = None
+        self.clients = []
+        self.uses = []
+        
+    
+    def create_client(self):
+        
+        """Creates a SessionsClient on its own keepalive channel, returns (client, channel)"""
+        
+        import dialogflow
+        from google.api_core import grpc_helpers
+        from google.oauth2.service_account import Credentials
+        
+        if self.credentials is None:
+            self.credentials = Credentials.from_service_account_file(dialogflow_config_path)
+        channel = grpc_helpers.create_channel(
+            dialogflow.SessionsClient.SERVICE_ADDRESS,
+            credentials=self.credentials,
+            scopes=dialogflow.SessionsClient._DEFAULT_SCOPES,
+            options=channel_options
+        )
+        return (dialogflow.SessionsClient(channel=channel), channel)
+    
+    
+    def check_fork(self):
+        
+        """Drops clients inherited from a parent process, gRPC channels are not fork-safe"""
+        
+        if self.pid != os.getpid():
+            self.clients = []
+            self.uses = []
+            self.pid = os.getpid()
+            
     
-    session_client = dialogflow.SessionsClient(credentials=credentials)
-    session_dialogflow = session_client.session_path(project_id, user_id)
+    def get(self):
+        
+        """Returns the next client round-robin, channels are created lazily up to size"""
+        
+        with self.lock:
+            self.check_fork()
+            if len(self.clients) < self.size:
+                self.clients.append(self.factory())
+                self.uses.append(0)
+                index = len(self.clients) - 1
+            else:
+                index = next(self.counter) % self.size
+            self.uses[index] += 1
+            return self.clients[index][0]
+        
+    
+    def health_check(self, timeout=5):
+        
+        """Fills the pool, waits up to timeout seconds in total for all channels to be ready and replaces broken ones"""
+        
+        with self.lock:
+            self.check_fork()
+            while len(self.clients) < self.size:
+                self.clients.append(self.factory())
+                self.uses.append(0)
+            clients = list(enumerate(self.clients))
+            
+        import grpc
+        
+        healthy = True
+        deadline = time.monotonic() + timeout
+        for index, (client, channel) in clients:
+            if channel is None:
+                continue
+            try:
+                grpc.channel_ready_future(channel).result(timeout=max(0, deadline - time.monotonic()))
+            except grpc.FutureTimeoutError:
+                healthy = False
+                with self.lock:
+                    if index < len(self.clients) and self.clients[index][1] is channel:
+                        self.clients[index] = self.factory()
+                        self.uses[index] = 0
+                channel.close()
+        return healthy
+    
+    
+    def stats(self):
+        
+        """Returns number of active channels and reuse count per channel index"""
+        
+        with self.lock:
+            self.check_fork()
+            return {'active_channels': len(self.clients),
+                    'channel_reuse': {str(index): n for index, n in enumerate(self.uses)}}
+
+
+sessions = SessionsClientPool(keys.get('DIALOGFLOW_CHANNELS', 2))
+
+
+@timed("dialogflow")
+def query_dialogflow(session_id, text):
+    
+    """Sends text to Dialogflow's detect_intent, returns the query_result"""
+    
+    import dialogflow
+    
+    session_client = sessions.get()
+    session_dialogflow = session_client.session_path(project_id, session_id)
 
     text_input = dialogflow.types.TextInput(
         text=text, language_code=language_code
     )
     query_input = dialogflow.types.QueryInput(text=text_input)
+    response = session_client.detect_intent(
+        session=session_dialogflow, query_input=query_input
+    )
+    return response.query_result
+
+
+def detect_intent_texts(user_id, text, payload=None):
+    
+    """Handles Dialogflow's intent detection and response generation"""
+    
+    #known quick replies and phrases skip Dialogflow
+    resolved = fastpath.resolve(user_id, text, payload)
+    if resolved:
+        intent, fields = resolved
+        tag(intent)
+        return Search(text,user_id,intent,fields).logic()
+    
+    from google.api_core.exceptions import InvalidArgument
+    
     try:
-        response = session_client.detect_intent(
-            session=session_dialogflow, query_input=query_input
-        )
+        query_result = query_dialogflow(user_id, text)
     except InvalidArgument:
         return ("I'm sorry, but your message was too long for me to handle,\
                 please stick to a maximum of 256 characters.", None, None)
 
-    intent = response.query_result.intent.display_name
-    fields = response.query_result.parameters.fields
+    capture_dialogflow(query_result)
+    intent = query_result.intent.display_name
+    fields = query_result.parameters.fields
 
     #let Dialogflow handle all non-related queries
-    print('INTENT', intent)
+    tag(intent)
+    logger.debug('Intent: {}'.format(intent))
     if intent == "default-welcome-intent":
-        return (response.query_result.fulfillment_text,
+        return (query_result.fulfillment_text,
                 ["Guided search", "Custom search", "More info"], None)
 
     elif not intent.startswith("search"):
-        return (response.query_result.fulfillment_text, None, None)
+        return (query_result.fulfillment_text, None, None)
 
     #custom logic
     else:
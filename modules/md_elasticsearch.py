@@ -1,28 +1,91 @@
 #Imports
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, TransportError
+import sys
 import json
-import random
+import hashlib
+import zlib
 import os
+from collections import namedtuple
 
 #Modules
+from .md_config import keys, load, Lazy
 from .md_join import join
 from .md_redis import redis_get
+from .md_cache import make_cache, LRUCache
+from .md_local_search import LocalSearch
+from .md_detail_store import DetailStore
+from .md_metrics import timer, timed
 
 
-#Elastic connection
-with open("config/keys.json") as f:
-    elastic_host = json.load(f)['ELASTIC_HOST']
-es = Elasticsearch("http://{}:9200".format(elastic_host))
+#Elastic connection, created on first use
+elastic_host = keys.get('ELASTIC_HOST')
+
+#Result cache shared by all users, "local" (per process LRU) or "redis"
+search_cache = make_cache(keys.get('SEARCH_CACHE'), "search-cache",
+                          keys.get('SEARCH_CACHE_SIZE', 1024),
+                          keys.get('SEARCH_CACHE_TTL', 600))
+
+#Carousel fields by _id without the exact flag, filled by searches and read when paging through
+#the result window of a session, which keeps only _id and exact flag of each hit
+hit_cache = LRUCache(keys.get('HIT_CACHE_SIZE', 10000), keys.get('SEARCH_CACHE_TTL', 600))
+
+#Pre-rendered ingredient and nutrient texts, built by python -m modules.md_detail_store
+detail_store = DetailStore(keys['DETAIL_STORE']) if keys.get('DETAIL_STORE') else None
 
 #No urls
-with open("data/no_urls.json", "r") as f:
-    image_urls = json.load(f)
+image_urls = load("data/no_urls.json")
+
+#Subtitle emojis per rating
+rating_emojis = {None: "\U0001f636", 0: u"\u2639", 0.5: "\U0001F641",
+                 1: "\U0001f615", 1.5: "\U0001f610", 2: "\U0001f610",
+                 2.5: "\U0001f928", 3: "\U0001F642", 3.5: "\U0001F603",
+                 4: "\U0001F603"}
+
+#Fields read by fill_hit_list, search responses carry nothing else
+#documents enriched with "display" (subtitle, image_url) only need those
+source_fields = ["_recipe_id", "title", "url", "image_link", "rating", "recomm_perc",
+                 "categories.time", "categories.difficulty", "categories.cuisine",
+                 "categories.ingredient", "categories.special"]
+if keys.get('ELASTIC_DISPLAY_FIELDS') or keys.get('SEARCH_BACKEND') == "local":
+    source_fields = ["_recipe_id", "title", "url", "display"]
+
+#Ranking, "cascade" runs an exact and a partial match query, "boosted" one query scored by category boosts
+ranking = keys.get('RANKING', "cascade")
+boosts = keys.get('RANKING_BOOSTS', {"meal": 3, "time": 3, "difficulty": 2, "ingredient": 3, "special": 3,
+                                     "cuisine": 2, "occasion": 1, "technique": 1, "avoid": 3})
+min_boost = min(boosts.values())
+
+#Rating (0-4) and recommendation share (0-100) add at most 0.8 * min_boost,
+#so a partial match never reaches the score of an exact match
+rating_functions = [{"field_value_factor": {"field": "rating", "factor": 0.1 * min_boost, "missing": 0}},
+                    {"field_value_factor": {"field": "recomm_perc", "factor": 0.004 * min_boost, "missing": 0}}]
+
+#Result order for search_after cursors, _id breaks ties between equal scores
+cursor_sort = [{"_score": "desc"}, {"_id": "asc"}]
+
+#Compact search hit, stored as list in sessions and caches
+Hit = namedtuple('Hit', ['id', 'recipe_id', 'image_url', 'subtitle', 'title', 'url', 'exact'])
+
+
+def filter_values(vals):
+    
+    """Returns the values a search filters an entity by, None when it does not filter"""
+    
+    #skip difficulty normal, i.e. no preferences
+    if vals == [None] or vals == [] or "Normal" in vals:
+        return None
+    #Standard and Long if Long
+    if "Long" in vals and "Standard" not in vals:
+        return vals + ["Standard"]
+    return vals
 
     
 class Elastic:
     
-    def __init__(self):
+    def __init__(self, client=None):
         
+        self.client = client or es
+        self.documents = client or documents
         self.index = "recipes"
         self.doc_type = "recipe"
         self.exact_match = True
@@ -37,13 +100,10 @@ class Elastic:
         all_bools = []
         for k,vals in state_dict['search-params'].items():
          
-            #skip difficulty normal, i.e. no preferences
-            if vals == [None] or vals == [] or "Normal" in vals:
+            vals = filter_values(vals)
+            if vals is None:
                 continue
             else:
-                #Standard and Long if Long
-                if "Long" in vals and "Standard" not in vals:
-                    vals.append("Standard")
                 #must query for ingredient/special, must_not for must-not should for rest
                 if k in ["ingredient", "special"]:
                     query = "must"
@@ -61,54 +121,150 @@ class Elastic:
         return all_bools
         
     
-    def must_query(self, b=0):
+    def cache_key(self, cursor, size):
+        
+        """Order-independent hash of the bool clauses plus result window"""
+        
+        clauses = []
+        for clause in self.bools:
+            for query, terms in clause["bool"].items():
+                values = sorted("{}={}".format(field, term["value"])
+                                for t in terms for field, term in t["term"].items())
+                clauses.append([query, values])
+        canonical = json.dumps([sorted(clauses), cursor, size, ranking], separators=(',', ':'))
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+    
+    
+    def must_query(self, b=0, size=5):
         
         """Fits search terms into Elasticsearch body structure for MUST query"""
         
-        return {"from": b, "size": 5, "query" : {"bool" : {"must" : self.bools}}}
+        return {"from": b, "size": size, "_source": source_fields,
+                "query" : {"bool" : {"must" : self.bools}}}
+    
+    def should_query(self, b=0, size=5):
+        
+        """Fits search terms into Elasticsearch body structure for SHOULD query, without exact matches"""
+        
+        return {"from": b, "size": size, "_source": source_fields,
+                "query" : {"bool" : {"should" : self.bools,
+                                     "must_not" : [{"bool" : {"must" : self.bools}}]}}}
+    
+    
+    def facet_query(self, category, values):
+        
+        """MUST query without hits, counts the exact matches left by each value of category"""
+        
+        return {"size": 0, "query" : {"bool" : {"must" : self.bools}},
+                "aggs" : {"facets" : {"terms" : {"field" : "categories.{}.keyword".format(category),
+                                                 "include" : values, "size" : len(values)}}}}
+    
+    
+    def after(self, body, search_after=None):
+        
+        """Sorts a query body for cursor paging, continues after the sort values of a previous hit"""
+        
+        body = dict(body, sort=cursor_sort)
+        if search_after:
+            body["search_after"] = search_after
+        return body
+    
+    
+    def clause_boost(self, clause):
+        
+        """Returns boost of the category a bool clause of build_query filters"""
+        
+        query, terms = next(iter(clause["bool"].items()))
+        if query == "must_not":
+            return boosts["avoid"]
+        field = next(iter(terms[0]["term"]))
+        return boosts[field.split(".")[1]]
+    
     
-    def should_query(self, b=0):
+    def boosted_query(self, b=0, size=5):
         
-        """Fits search terms into Elasticsearch body structure for SHOULD query"""
+        """Fits search terms into one scored query, every matching category adds its boost"""
         
-        return {"from": b, "size": 5, "query" : {"bool" : {"should" : self.bools}}}
+        clauses = [{"constant_score": {"filter": clause, "boost": self.clause_boost(clause)}}
+                   for clause in self.bools]
+        return {"from": b, "size": size, "_source": source_fields,
+                "query" : {"function_score" : {"query" : {"bool" : {"should" : clauses}},
+                                               "functions" : rating_functions,
+                                               "score_mode" : "sum", "boost_mode" : "sum"}}}
         
     
-    def fill_hit_list(self, hits):
+    def fill_hit_list(self, hits, limit=5, exact=True):
         
-        """Returns display parameters for Messenger webslider (max=5)"""
+        """Returns display parameters for Messenger webslider (max=limit), returns last hit used"""
         
+        last = None
+        seen = {h.id for h in self.hit_list}
         for hit in hits:
             
-            subtitle = self.get_sub(hit['_source']['categories'],
-                                    hit['_source']['rating'],
-                                    hit['_source']['recomm_perc'])
-            
-            hit_dict = {'id': hit['_id'],
-                 'recipe_id': hit['_source']['_recipe_id'],
-                 'image_url': hit['_source']['image_link'],
-                 'subtitle': subtitle,
-                 'title': hit['_source']['title'],
-                 'url': hit['_source']['url'] }
+            if len(self.hit_list) >= limit:
+                break
+            last = hit
+            if hit['_id'] in seen:
+                continue
             
-            if hit_dict['image_url'] is None:
-                hit_dict['image_url'] = random.choice(image_urls['no-urls'])
+            self.hit_list.append(self.make_hit(hit, exact))
+            seen.add(hit['_id'])
+        return last
+    
+    
+    def make_hit(self, doc, exact):
+        
+        """Returns Hit of a search hit or _mget doc and remembers its carousel fields"""
+        
+        source = doc['_source']
+        display = source.get('display') or self.get_display(doc['_id'], source)
+        hit = Hit(doc['_id'], source['_recipe_id'], display['image_url'],
+                  display['subtitle'], source['title'], source['url'], exact)
+        hit_cache.set(doc['_id'], tuple(hit[:-1]))
+        return hit
+    
+    
+    def get_hits(self, entries):
+        
+        """Returns Hits for [_id, exact] entries of a result window, skips recipes no longer found
+        
+        Carousel fields come from hit_cache, missing ones from one _mget.
+        """
+        
+        found = {}
+        for entry in entries:
+            cached = hit_cache.get(entry[0])
+            if cached:
+                found[entry[0]] = cached
+        missing = [entry[0] for entry in entries if entry[0] not in found]
+        if missing:
+            with timer("es_get"):
+                res = self.client.mget(index=self.index, doc_type=self.doc_type, body={'ids': missing},
+                                       _source_include=source_fields)
+            for doc in res['docs']:
+                if doc.get('found'):
+                    found[doc['_id']] = tuple(self.make_hit(doc, False)[:-1])
+        #windows stored by earlier releases hold whole hits, the exact flag is always last
+        return [Hit(*found[entry[0]], entry[-1]) for entry in entries if entry[0] in found]
             
-            #dedup
-            ids = [hit['id'] for hit in self.hit_list]
-            if not hit_dict['id'] in ids:
-                self.hit_list.append(hit_dict)
+    
+    def get_display(self, recipe_id, source):
+        
+        """Returns carousel subtitle and image, computed once per recipe at index or load time"""
+        
+        image_url = source.get('image_link')
+        if image_url is None:
+            no_urls = image_urls['no-urls']
+            image_url = no_urls[zlib.crc32(recipe_id.encode("utf-8")) % len(no_urls)]
+        
+        return {'subtitle': self.get_sub(source['categories'], source['rating'], source['recomm_perc']),
+                'image_url': image_url}
                 
     
     def get_sub(self, categories, rating, recomm_perc):
         
         """Returns string representation for subtitle"""
         
-        mapping = {None: "\U0001f636", 0: u"\u2639", 0.5: "\U0001F641",
-                  1: "\U0001f615", 1.5: "\U0001f610", 2: "\U0001f610",
-                  2.5: "\U0001f928", 3: "\U0001F642", 3.5: "\U0001F603",
-                  4: "\U0001F603"}
-        
         #categories
         meal = ["Main"] # to be adapted
         time_diff = [categories["time"][0], categories["difficulty"][0]]
@@ -122,7 +278,7 @@ class Elastic:
         all_cats = 'Tags: {}'.format(", ".join(all_cats))
             
         #rating/recomm
-        first_line_tuple = (mapping[rating], str(rating), str(recomm_perc))
+        first_line_tuple = (rating_emojis[rating], str(rating), str(recomm_perc))
         first_line = "{} {}/4 | \U0001F374 {}%".format(*first_line_tuple)
         
         return first_line + "\n" + all_cats[:100]
@@ -132,32 +288,136 @@ class Elastic:
         
         """Runs Elasticsearch and fills max. 5 entries in the hit list"""
 
-        res = es.search(
-                index = self.index,
-                doc_type = self.doc_type,
-                body = body
-            )
+        with timer("es_search"):
+            res = self.client.search(
+                    index = self.index,
+                    doc_type = self.doc_type,
+                    body = body
+                )
         self.fill_hit_list(res['hits']['hits'][:5])
+        
+        
+    def run_msearch(self, bodies):
+        
+        """Runs several searches in one round trip, returns their responses"""
+        
+        body = []
+        for query in bodies:
+            body += [{}, query]
+        with timer("es_search"):
+            res = self.client.msearch(index = self.index, doc_type = self.doc_type, body = body)
+        
+        for response in res['responses']:
+            if 'error' in response:
+                raise TransportError(response.get('status', 500), 'msearch', response['error'])
+        return res['responses']
       
         
-    def search(self, state_dict):
+    def search(self, state_dict, size=5, cursor=None):
         
-        """Builds and runs search"""
+        """Builds and runs search, returns up to size hits following cursor
+        
+        self.cursor continues the search on the next call, None once all results were returned.
+        """
         
-        # self.boosts = {"meal": 3, "time": 3, "difficulty": 2, "ingredient": 3,
-        #               "special": 3, "cuisine": 2, "occasion": 1, "technique": 1}
         self.hit_list = []
         self.bools = self.build_query(state_dict)
         
-        #run must search
-        self.run_search(self.must_query(state_dict['search_batch']))
+        #identical searches of other users are served from the cache
+        if search_cache:
+            key = self.cache_key(cursor, size)
+            cached = search_cache.get(key)
+            if cached:
+                self.hit_list = [Hit._make(hit) for hit in cached['hits']]
+                for hit in self.hit_list:
+                    hit_cache.set(hit.id, tuple(hit[:-1]))
+                self.exact_match = cached['exact']
+                self.cursor = cached['cursor']
+                return (self.hit_list, self.exact_match)
+        
+        if ranking == "boosted":
+            self.boosted_search(size, cursor)
+        else:
+            self.cascade_search(size, cursor)
+        
+        if search_cache:
+            search_cache.set(key, {'hits': self.hit_list, 'exact': self.exact_match, 'cursor': self.cursor})
+        return (self.hit_list, self.exact_match)
+        
+        
+    def cascade_search(self, size, cursor=None):
+        
+        """Exact matches first, partial matches fill up the hit list
+        
+        The cursor holds the sort values of the last exact and partial hit shown, "must" is
+        dropped once exact matches are exhausted.
+        """
+        
+        cursor = cursor or {"must": None, "should": None}
+        self.cursor = dict(cursor)
+        
+        #must and should query in one round trip while exact matches are left
+        bodies = [self.after(self.should_query(0, size), cursor.get("should"))]
+        if "must" in cursor:
+            bodies.insert(0, self.after(self.must_query(0, size), cursor["must"]))
+        responses = self.run_msearch(bodies)
+        should_hits = responses[-1]['hits']['hits']
+        
+        if "must" in cursor:
+            must_hits = responses[0]['hits']['hits']
+            last = self.fill_hit_list(must_hits, size)
+            if len(must_hits) < size:
+                del self.cursor["must"]
+            elif last:
+                self.cursor["must"] = last['sort']
         
-        #if under 5 results, run should query for remaining, avoid duplicate results
-        if len(self.hit_list) < 5:
+        #if under size results, fill remaining with should hits
+        if len(self.hit_list) < size:
             self.exact_match = False
-            self.run_search(self.should_query(state_dict['search_batch'],
-                                              5+len(self.hit_list)))
-        return (self.hit_list, self.exact_match)
+            last = self.fill_hit_list(should_hits, size, exact=False)
+            if len(should_hits) < size and last is (should_hits[-1] if should_hits else None):
+                self.cursor = None
+            elif last:
+                self.cursor["should"] = last['sort']
+        
+        
+    def boosted_search(self, size, cursor=None):
+        
+        """Exact and partial matches from one query, exact ones score at least the sum of all boosts"""
+        
+        with timer("es_search"):
+            res = self.client.search(index = self.index, doc_type = self.doc_type,
+                                     body = self.after(self.boosted_query(0, size), cursor and cursor.get("boosted")))
+        hits = res['hits']['hits']
+        exact_score = sum(self.clause_boost(clause) for clause in self.bools) - 0.1 * min_boost
+        exact = [hit for hit in hits if hit['_score'] >= exact_score]
+        self.fill_hit_list(exact, size)
+        if len(self.hit_list) < size:
+            self.exact_match = False
+            self.fill_hit_list(hits[len(exact):], size, exact=False)
+        self.cursor = {"boosted": hits[-1]['sort']} if len(hits) == size else None
+        
+        
+    def facets(self, state_dict, category, values):
+        
+        """Returns {value: number of exact matches} when value of category is added to the search"""
+        
+        self.bools = self.build_query({'search-params': {k: list(v) for k,v in state_dict['search-params'].items()}})
+        
+        if search_cache:
+            key = self.cache_key(["facets", category, values], 0)
+            cached = search_cache.get(key)
+            if cached:
+                return cached
+        
+        with timer("es_search"):
+            res = self.client.search(index = self.index, doc_type = self.doc_type,
+                                     body = self.facet_query(category, values))
+        counts = {bucket['key']: bucket['doc_count'] for bucket in res['aggregations']['facets']['buckets']}
+        
+        if search_cache:
+            search_cache.set(key, counts)
+        return counts
         
         
     ################# Retrieve Functions ##########################
@@ -166,16 +426,29 @@ class Elastic:
     
         """Retrieves recipe details based on _id"""
         
-        res = es.get(index=self.index, doc_type=self.doc_type, id=recipe_id)
+        if detail_store:
+            text = detail_store.get(recipe_id, field)
+            if text is not None:
+                return text
+        
+        with timer("es_get"):
+            res = self.documents.get(index=self.index, doc_type=self.doc_type, id=recipe_id)
+        return self.render_details(res['_source'], field)
+        
+        
+    @timed("render")
+    def render_details(self, source, field):
+        
+        """Renders ingredient or nutrient text of a recipe"""
         
         #servings data
-        header = '{}\n\n'.format(res['_source'].get("title"))
-        servings = res['_source'].get("servings")
+        header = '{}\n\n'.format(source.get("title"))
+        servings = source.get("servings")
         
         #nutrient data
         if field == "nutrients":
-            if res['_source'].get("nutrients"):
-                res_list = Nutrients(res['_source']['nutrients']).get_nutrient_list()
+            if source.get("nutrients"):
+                res_list = Nutrients(source['nutrients']).get_nutrient_list()
                 res_list = 'Nutrients incl. % of daily need:\n' +'\u2022 ' +'\n\u2022 '.join(res_list)
                 if servings:
                     servings = "\n\nPer serving, serves: {}.".format(servings)
@@ -186,7 +459,7 @@ class Elastic:
         
         #ingredient data
         elif field == "ingredients":
-            res_list = self.get_grouped_ingredients(res['_source']['ingredients'])
+            res_list = self.get_grouped_ingredients(source.get('ingredients') or [])
             if res_list:
                 if servings:
                      servings = "\n\nServes: {}.".format(servings)
@@ -221,8 +494,8 @@ class Elastic:
         
         option = int(payload.split("_")[2])
         try:
-            recipe_id = redis_get(user_id)['search_results'][option]
-        except TypeError:
+            recipe_id = redis_get(user_id, ['search_results'])['search_results'][option]
+        except (TypeError, KeyError, IndexError):
             return None
         return self.get_recipe_details(recipe_id, kind)
 
@@ -268,3 +541,54 @@ class Nutrients:
             percent = round(v / self.mapping_nutrients[k] * 100)
             nutrient_list.append("{}: {} ({}%)".format(key,v,percent))
         return nutrient_list
+
+
+def connect():
+    return Elasticsearch("http://{}:9200".format(elastic_host), timeout=keys.get('ELASTIC_TIMEOUT', 5))
+
+
+def create_client():
+    
+    """Returns search client, "local" answers searches from an in-memory recipe snapshot"""
+    
+    if keys.get('SEARCH_BACKEND') == "local":
+        #keeps the fields of search hits and scoring only, carousel fields are computed while loading
+        return LocalSearch.from_snapshot(keys.get('LOCAL_SEARCH_SNAPSHOT', "data/recipes.jsonl.gz"),
+                                         source_fields + ["rating", "recomm_perc"], Elastic().get_display)
+    return connect()
+
+es = Lazy(create_client)
+
+#Full recipe documents for details missing in the detail store, the local backend does not keep them
+documents = Lazy(connect) if keys.get('SEARCH_BACKEND') == "local" else es
+
+
+def enrich_index(client, index="recipes", doc_type="recipe"):
+    
+    """Stores carousel subtitle and image with every document of the index"""
+    
+    from elasticsearch.helpers import scan, bulk
+    
+    elastic = Elastic(client)
+    docs = scan(client, index=index, query={"query": {"match_all": {}}})
+    actions = ({'_op_type': 'update', '_index': index, '_type': doc_type, '_id': doc['_id'],
+                'doc': {'display': elastic.get_display(doc['_id'], doc['_source'])}}
+               for doc in docs)
+    return bulk(client, actions)[0]
+
+
+if __name__ == '__main__':
+    
+    #python -m modules.md_elasticsearch invalidate-cache, run after reloading the index
+    #only the "redis" cache is shared, "local" entries live in each worker until SEARCH_CACHE_TTL
+    if sys.argv[1:] == ["invalidate-cache"]:
+        if keys.get('SEARCH_CACHE') != "redis":
+            print("SEARCH_CACHE is {!r}, only the \"redis\" cache can be invalidated for running workers. "
+                  "Restart them or wait SEARCH_CACHE_TTL.".format(keys.get('SEARCH_CACHE')))
+            sys.exit(1)
+        search_cache.invalidate()
+        print("Search cache invalidated.")
+    
+    #python -m modules.md_elasticsearch enrich, then set ELASTIC_DISPLAY_FIELDS
+    elif sys.argv[1:] == ["enrich"]:
+        print("{} documents enriched.".format(enrich_index(es.resolve())))
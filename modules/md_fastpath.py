@@ -0,0 +1,114 @@
+#Imports
+import sys
+import uuid
+import threading
+
+#Modules
+from .md_config import load
+from .md_redis import redis_exists
+
+#Phrase table
+phrases = load("data/fastpath.json")
+
+
+class FastPath:
+
+    def __init__(self, table):
+
+        self.table = {self.normalize(k): v for k,v in table.items()}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def normalize(self, text):
+
+        """Normalizes phrases for exact matching"""
+
+        return " ".join(text.lower().split())
+
+
+    def lookup(self, text, payload=None):
+
+        """Returns table entry for quick-reply payload or exact phrase"""
+
+        for candidate in (payload, text):
+            if candidate:
+                entry = self.table.get(self.normalize(candidate))
+                if entry:
+                    return entry
+        return None
+
+
+    def resolve(self, user_id, text, payload=None):
+
+        """Returns (intent, fields) like Dialogflow's query_result, None on miss"""
+
+        entry = self.lookup(text, payload)
+
+        #context dependent phrases only resolve within a running search
+        if entry and entry.get("session", True) and not redis_exists(user_id):
+            entry = None
+
+        with self.lock:
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            return None
+
+        from google.protobuf.struct_pb2 import Struct
+
+        params = Struct()
+        params.update(entry.get("params", {}))
+        return (entry["intent"], params.fields)
+
+
+    def hit_rate(self):
+
+        """Returns share of messages resolved without Dialogflow"""
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+    def stats(self):
+
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
+
+
+fastpath = FastPath(phrases)
+
+
+def verify(prime=None):
+
+    """Sends every table phrase to Dialogflow and returns mismatches"""
+
+    from .md_dialogflow import query_dialogflow
+
+    mismatches = []
+    for phrase, entry in phrases.items():
+        session_id = "fastpath-verify-{}".format(uuid.uuid4().hex)
+        if prime:
+            query_dialogflow(session_id, prime)
+        result = query_dialogflow(session_id, phrase)
+        intent = result.intent.display_name
+        params = {k: sorted(v.string_value for v in value.list_value.values)
+                  for k,value in result.parameters.fields.items()
+                  if len(value.list_value.values) > 0}
+        expected = {k: sorted(v) for k,v in entry.get("params", {}).items()}
+        if intent != entry["intent"] or params != expected:
+            mismatches.append((phrase, entry["intent"], expected, intent, params))
+    return mismatches
+
+
+if __name__ == '__main__':
+
+    #python -m modules.md_fastpath ["priming utterance"]
+    mismatches = verify(sys.argv[1] if len(sys.argv) > 1 else None)
+    for phrase, intent, expected, df_intent, df_params in mismatches:
+        print("{!r}: table {} {} | dialogflow {} {}".format(phrase, intent, expected,
+                                                          df_intent, df_params))
+    print("{} of {} phrases match Dialogflow".format(len(phrases) - len(mismatches), len(phrases)))
+    sys.exit(1 if mismatches else 0)
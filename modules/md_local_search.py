@@ -0,0 +1,474 @@
+#Imports
+import sys
+import json
+import gzip
+import math
+import heapq
+import bisect
+import random
+from elasticsearch import NotFoundError
+
+
+def open_snapshot(path, mode="rt"):
+
+    """Opens a recipe snapshot, gzipped if the path ends with .gz"""
+
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def iter_bits(bitmap):
+
+    """Yields positions of set bits in ascending order"""
+
+    while bitmap:
+        low = bitmap & -bitmap
+        yield low.bit_length() - 1
+        bitmap ^= low
+
+
+def popcount(bitmap):
+    return bin(bitmap).count("1")
+
+
+def project(source, includes):
+
+    """Returns source restricted to dotted include paths like Elasticsearch's _source filtering"""
+
+    if includes is None or includes is True:
+        return source
+    projected = {}
+    for path in ([includes] if isinstance(includes, str) else includes):
+        node, target = source, projected
+        keys = path.split(".")
+        for k in keys[:-1]:
+            if not isinstance(node, dict) or k not in node:
+                break
+            node = node[k]
+            target = target.setdefault(k, {})
+        else:
+            if isinstance(node, dict) and keys[-1] in node:
+                target[keys[-1]] = node[keys[-1]]
+    return projected
+
+
+class LocalSearch:
+
+    """In-memory recipe index answering the Elasticsearch queries built by Elastic
+
+    Every category value keeps a bitmap (a Python int) of the documents it occurs in,
+    bool queries become bitmap operations. Scores follow Elasticsearch's BM25 for
+    keyword fields without norms, i.e. a term adds its idf. Documents are kept in _id
+    order, so ties are ordered by _id like the search_after sort of Elastic.
+
+    Only the source fields listed in fields are kept (all if None), plus "display" when
+    display(recipe_id, source) computes carousel fields while loading.
+    """
+
+    def __init__(self, docs, fields=None, display=None):
+
+        #full sources are dropped while reading, postings hold read order until sorting by _id
+        rows = []
+        postings = {}
+        for doc in docs:
+            source = doc["_source"]
+            kept = source if fields is None else {k: source[k] for k in fields if k in source}
+            if display and "display" not in kept:
+                kept["display"] = source.get("display") or display(doc["_id"], source)
+            for k,vals in (source.get("categories") or {}).items():
+                field = "categories.{}.keyword".format(k)
+                for v in vals or []:
+                    postings.setdefault(field, {}).setdefault(v, []).append(len(rows))
+            rows.append((doc["_id"], kept))
+
+        order = sorted(range(len(rows)), key=lambda i: rows[i][0])
+        moved = [0] * len(rows)
+        for position, i in enumerate(order):
+            moved[i] = position
+        self.ids = [rows[i][0] for i in order]
+        self.sources = [rows[i][1] for i in order]
+        self.positions = {recipe_id: position for position, recipe_id in enumerate(self.ids)}
+        del rows
+
+        #numeric fields read by function_score, filled on first use
+        self.columns = {}
+
+        #sorted position lists to bitmaps
+        self.count = len(self.ids)
+        self.all = (1 << self.count) - 1
+        self.bitmaps = {}
+        self.idfs = {}
+        for field, values in postings.items():
+            for v, positions in values.items():
+                bits = bytearray((self.count + 8) // 8)
+                for i in positions:
+                    position = moved[i]
+                    bits[position >> 3] |= 1 << (position & 7)
+                self.bitmaps[(field, v)] = int.from_bytes(bits, "little")
+                df = len(set(positions))
+                self.idfs[(field, v)] = math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+
+
+    @classmethod
+    def from_snapshot(cls, path, fields=None, display=None):
+
+        """Loads JSON lines of {"_id": ..., "_source": ...} documents"""
+
+        with open_snapshot(path) as f:
+            return cls((json.loads(line) for line in f if line.strip()), fields, display)
+
+
+    def categories(self, position):
+
+        """Returns the categories of a document, rebuilt from the bitmaps"""
+
+        categories = {}
+        for (field, v), bitmap in self.bitmaps.items():
+            if bitmap >> position & 1:
+                categories.setdefault(field.split(".")[1], []).append(v)
+        return categories
+
+
+    ################# Query Evaluation ##########################
+
+    def evaluate(self, query):
+
+        """Returns (bitmap, scorers) for a query, scorers are (bitmap, weight) pairs"""
+
+        kind, spec = next(iter(query.items()))
+
+        if kind == "term":
+            field, value = next(iter(spec.items()))
+            boost = 1.0
+            if isinstance(value, dict):
+                boost = value.get("boost", 1.0)
+                value = value["value"]
+            bitmap = self.bitmaps.get((field, value), 0)
+            return (bitmap, [(bitmap, self.idfs.get((field, value), 0.0) * boost)])
+
+        elif kind == "terms":
+            bitmap = 0
+            scorers = []
+            for field, values in spec.items():
+                for value in values:
+                    term_bitmap, term_scorers = self.evaluate({"term": {field: value}})
+                    bitmap |= term_bitmap
+                    scorers += term_scorers
+            return (bitmap, scorers)
+
+        elif kind == "match_all":
+            return (self.all, [(self.all, spec.get("boost", 1.0))])
+
+        elif kind == "constant_score":
+            bitmap, _ = self.evaluate(spec["filter"])
+            return (bitmap, [(bitmap, spec.get("boost", 1.0))])
+
+        elif kind == "bool":
+            return self.evaluate_bool(spec)
+
+        raise ValueError("Unsupported query type for local search: {}".format(kind))
+
+
+    def evaluate_bool(self, spec):
+
+        """Evaluates must/filter/should/must_not clauses like Elasticsearch's bool query"""
+
+        as_list = lambda v: v if isinstance(v, list) else [v]
+        must = [self.evaluate(q) for q in as_list(spec.get("must", []))]
+        filters = [self.evaluate(q)[0] for q in as_list(spec.get("filter", []))]
+        should = [self.evaluate(q) for q in as_list(spec.get("should", []))]
+        must_not = [self.evaluate(q)[0] for q in as_list(spec.get("must_not", []))]
+
+        bitmap = self.all
+        scorers = []
+        for clause_bitmap, clause_scorers in must:
+            bitmap &= clause_bitmap
+            scorers += clause_scorers
+        for clause_bitmap in filters:
+            bitmap &= clause_bitmap
+
+        #without must/filter at least one should clause has to match
+        if should:
+            should_bitmap = 0
+            for clause_bitmap, clause_scorers in should:
+                should_bitmap |= clause_bitmap
+                scorers += clause_scorers
+            minimum = spec.get("minimum_should_match", 0 if must or filters else 1)
+            if minimum:
+                bitmap &= should_bitmap
+
+        for clause_bitmap in must_not:
+            bitmap &= ~clause_bitmap & self.all
+
+        #pure must_not/filter queries score like match_all
+        if not must and not should:
+            scorers = [(self.all, 1.0)] if not filters else []
+        return (bitmap, scorers)
+
+
+    def rank(self, bitmap, scorers):
+
+        """Returns [(score, bitmap)] partitions of the matched docs, best first"""
+
+        parts = [(0.0, bitmap)]
+        for scorer_bitmap, weight in scorers:
+            if not weight:
+                continue
+            split = []
+            for score, part in parts:
+                inside = part & scorer_bitmap
+                if inside:
+                    split.append((score + weight, inside))
+                if part ^ inside:
+                    split.append((score, part ^ inside))
+            parts = split
+
+        #docs matching different terms can score the same, equal scores are ordered by _id
+        merged = {}
+        for score, part in parts:
+            merged[score] = merged.get(score, 0) | part
+        return sorted(merged.items(), key=lambda p: -p[0])
+
+
+    def following(self, search_after):
+
+        """Returns (score, first position) of the docs sorted after search_after's [score, _id]"""
+
+        score, recipe_id = search_after
+        return (score, bisect.bisect_right(self.ids, recipe_id))
+
+
+    def top(self, bitmap, scorers, start, size, search_after=None):
+
+        """Returns [(score, position)] for the requested window of ranked docs"""
+
+        after_score, after_position = self.following(search_after) if search_after else (None, 0)
+        hits = []
+        skipped = 0
+        for score, part in self.rank(bitmap, scorers):
+            if len(hits) >= size:
+                break
+            if search_after:
+                if score > after_score:
+                    continue
+                if score == after_score:
+                    part &= ~((1 << after_position) - 1)
+            if skipped + popcount(part) <= start:
+                skipped += popcount(part)
+                continue
+            for position in iter_bits(part):
+                if skipped < start:
+                    skipped += 1
+                    continue
+                hits.append((score, position))
+                if len(hits) >= size:
+                    break
+        return hits
+
+
+    def column(self, field):
+
+        """Returns (values by position, smallest, largest) of a top-level source field"""
+
+        if field not in self.columns:
+            values = [source.get(field) for source in self.sources]
+            present = [v for v in values if v is not None] or [0]
+            self.columns[field] = (values, min(present), max(present))
+        return self.columns[field]
+
+
+    def top_scored(self, bitmap, scorers, spec, start, size, search_after=None):
+
+        """Like top for a function_score query, adds its field_value_factor functions to each score
+
+        Partitions are scored best first until none can reach the requested window anymore.
+        """
+
+        if spec.get("score_mode", "multiply") != "sum" or spec.get("boost_mode", "multiply") != "sum":
+            raise ValueError("Local search only supports function_score with score_mode and boost_mode sum")
+        functions = []
+        max_bonus = 0.0
+        for function in spec.get("functions", []):
+            if set(function) != {"field_value_factor"} or function["field_value_factor"].get("modifier", "none") != "none":
+                raise ValueError("Unsupported function for local search: {}".format(json.dumps(function)))
+            factor = function["field_value_factor"]
+            values, smallest, largest = self.column(factor["field"])
+            weight, missing = factor.get("factor", 1.0), factor.get("missing", 0)
+            functions.append((values, weight, missing))
+            max_bonus += max(weight * smallest, weight * largest, weight * missing)
+
+        after_score, after_position = self.following(search_after) if search_after else (None, 0)
+        scored = []
+        end = start + size
+        for score, part in self.rank(bitmap, scorers):
+            if len(scored) >= end and score + max_bonus < heapq.nlargest(end, scored)[-1][0]:
+                break
+            for position in iter_bits(part):
+                bonus = 0.0
+                for values, weight, missing in functions:
+                    value = values[position]
+                    bonus += weight * (missing if value is None else value)
+                if search_after and (score + bonus > after_score or
+                                     score + bonus == after_score and position < after_position):
+                    continue
+                scored.append((score + bonus, -position))
+        return [(score, -position) for score, position in heapq.nlargest(end, scored)[start:]]
+
+
+    ################# Elasticsearch API ##########################
+
+    def hit(self, position, score=None, includes=None):
+
+        return {"_index": "recipes", "_type": "recipe", "_id": self.ids[position],
+                "_score": score, "_source": project(self.sources[position], includes)}
+
+
+    def search(self, index=None, doc_type=None, body=None):
+
+        """Answers a search body with Elasticsearch's response structure"""
+
+        body = body or {}
+        sort = body.get("sort")
+        if sort not in (None, [{"_score": "desc"}, {"_id": "asc"}]):
+            raise ValueError("Local search only sorts by _score and _id: {}".format(json.dumps(sort)))
+        search_after = body.get("search_after")
+        query = body.get("query", {"match_all": {}})
+        if "function_score" in query:
+            spec = query["function_score"]
+            bitmap, scorers = self.evaluate(spec.get("query", {"match_all": {}}))
+            hits = self.top_scored(bitmap, scorers, spec, body.get("from", 0), body.get("size", 10), search_after)
+        else:
+            bitmap, scorers = self.evaluate(query)
+            hits = self.top(bitmap, scorers, body.get("from", 0), body.get("size", 10), search_after)
+
+        response_hits = []
+        for score, position in hits:
+            hit = self.hit(position, score, body.get("_source"))
+            if sort:
+                hit["sort"] = [score, self.ids[position]]
+            response_hits.append(hit)
+        response = {"hits": {"total": popcount(bitmap),
+                             "max_score": hits[0][0] if hits else None,
+                             "hits": response_hits}}
+        if body.get("aggs"):
+            response["aggregations"] = {name: self.aggregate(agg, bitmap) for name, agg in body["aggs"].items()}
+        return response
+
+
+    def aggregate(self, agg, bitmap):
+
+        """Answers a terms aggregation over the matched docs, buckets by descending count"""
+
+        kind, spec = next(iter(agg.items()))
+        if kind != "terms":
+            raise ValueError("Unsupported aggregation for local search: {}".format(kind))
+        field = spec["field"]
+        values = spec.get("include")
+        if values is None:
+            values = [v for f, v in self.bitmaps if f == field]
+        buckets = []
+        for v in values:
+            count = popcount(bitmap & self.bitmaps.get((field, v), 0))
+            if count:
+                buckets.append({"key": v, "doc_count": count})
+        buckets.sort(key=lambda bucket: (-bucket["doc_count"], bucket["key"]))
+        size = spec.get("size", 10)
+        return {"doc_count_error_upper_bound": 0,
+                "sum_other_doc_count": sum(bucket["doc_count"] for bucket in buckets[size:]),
+                "buckets": buckets[:size]}
+
+
+    def msearch(self, body, index=None, doc_type=None):
+
+        """Answers alternating header/body lists like Elasticsearch's _msearch"""
+
+        return {"responses": [self.search(index, doc_type, query) for query in body[1::2]]}
+
+
+    def mget(self, body, index=None, doc_type=None, **params):
+
+        """Answers {"ids": [...]} like Elasticsearch's _mget"""
+
+        docs = []
+        for id in body["ids"]:
+            position = self.positions.get(id)
+            if position is None:
+                docs.append({"_index": "recipes", "_type": "recipe", "_id": id, "found": False})
+            else:
+                docs.append(dict(self.hit(position, includes=params.get("_source_include")), found=True))
+        return {"docs": docs}
+
+
+    def get(self, index, id, doc_type=None):
+
+        position = self.positions.get(id)
+        if position is None:
+            raise NotFoundError(404, "not_found", {"_id": id, "found": False})
+        return dict(self.hit(position), found=True)
+
+
+
+################# Snapshot Tools ##########################
+
+def dump(client, path, index="recipes"):
+
+    """Writes all documents of the index to a snapshot"""
+
+    from elasticsearch.helpers import scan
+
+    with open_snapshot(path, "wt") as f:
+        for doc in scan(client, index=index, query={"query": {"match_all": {}}}):
+            f.write(json.dumps({"_id": doc["_id"], "_source": doc["_source"]}) + "\n")
+
+
+def random_state(categories, rng):
+
+    """Builds search params from a random subset of a recipe's categories"""
+
+    params = {}
+    for k in ["meal", "time", "difficulty", "cuisine", "ingredient", "special"]:
+        vals = categories.get(k) or []
+        params[k] = rng.sample(vals, min(len(vals), rng.randint(0, 2))) or [None]
+    params["avoid"] = []
+    return {"search-params": params, "search_batch": 0}
+
+
+def compare(local, remote, runs=100, size=100, seed=0, index="recipes"):
+
+    """Runs random searches on both backends, returns mismatching queries"""
+
+    from .md_elasticsearch import Elastic
+
+    rng = random.Random(seed)
+    mismatches = []
+    for _ in range(runs):
+        elastic = Elastic()
+        elastic.bools = elastic.build_query(random_state(local.categories(rng.randrange(local.count)), rng))
+        for body in [elastic.must_query(0, size), elastic.should_query(0, size), elastic.boosted_query(0, size)]:
+            results = []
+            for client in [local, remote]:
+                res = client.search(index=index, doc_type="recipe", body=body)
+                results.append((res["hits"]["total"], {hit["_id"] for hit in res["hits"]["hits"]}))
+            (local_total, local_ids), (remote_total, remote_ids) = results
+            if local_total != remote_total or (remote_total <= size and local_ids != remote_ids):
+                mismatches.append((body, local_total, remote_total))
+    return mismatches
+
+
+if __name__ == '__main__':
+
+    #python -m modules.md_local_search dump|compare [snapshot]
+    from elasticsearch import Elasticsearch
+    from .md_config import keys
+    remote = Elasticsearch("http://{}:9200".format(keys['ELASTIC_HOST']))
+    path = sys.argv[2] if len(sys.argv) > 2 else keys.get('LOCAL_SEARCH_SNAPSHOT', "data/recipes.jsonl.gz")
+
+    if sys.argv[1] == "dump":
+        dump(remote, path)
+    elif sys.argv[1] == "compare":
+        mismatches = compare(LocalSearch.from_snapshot(path), remote)
+        for body, local_total, remote_total in mismatches:
+            print("local {} vs. elasticsearch {}: {}".format(local_total, remote_total, json.dumps(body)))
+        print("{} mismatching queries".format(len(mismatches)))
+        sys.exit(1 if mismatches else 0)
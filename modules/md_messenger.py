@@ -1,6 +1,6 @@
 #Imports
 from flask import Flask, request
-from fbmessenger import BaseMessenger
+from fbmessenger import BaseMessenger, MessengerClient
 from fbmessenger.templates import GenericTemplate
 from fbmessenger.elements import Text, Button, Element
 from fbmessenger import quick_replies
@@ -13,17 +13,22 @@ from fbmessenger.thread_settings import (
 )
 
 import random
-import json
+import threading
+from collections import OrderedDict as od
 from flask import current_app as app
 
 #Modules
+from .md_config import load
 from .md_dialogflow import detect_intent_texts
 from .md_elasticsearch import Elastic
+from .md_queue import Dispatcher
+from .md_send import make_session
+from .md_metrics import timed, turn, tag as tag_intent
+from .md_capture import capture, capture_reply
 
 
 #Responses
-with open("data/responses.json", "r") as f:
-    responses = json.load(f)
+responses = load("data/responses.json")
 
 #Helpers
 def process_quick_rpls(quick_rpls):
@@ -67,18 +72,19 @@ def get_recipe_hits(elastic_hits):
     for i,hit in enumerate(elastic_hits):
         btn1 = get_ingredient_button(i)
         btn2 = get_nutrient_button(i)
-        btn3 = get_recipe_button('full', hit['url'])
+        btn3 = get_recipe_button('full', hit.url)
         elements.append(Element(
-            title=hit['title'],
-            item_url=hit['url'],
-            image_url=hit['image_url'],
-            subtitle=hit['subtitle'],
+            title=hit.title,
+            item_url=hit.url,
+            image_url=hit.image_url,
+            subtitle=hit.subtitle,
             buttons=[btn1, btn2, btn3]
         ))
     
     return elements
 
  
+@timed("render")
 def display_recipe_hits(elastic_hits):
      
     """Displays hits in form of generic templates"""
@@ -91,19 +97,65 @@ def display_recipe_hits(elastic_hits):
 
 class Messenger(BaseMessenger):
     
-    def __init__(self, page_access_token):
+    def __init__(self, page_access_token, workers=8, session=None, timeout=None):
         self.page_access_token = page_access_token
+        self.local = threading.local()
+        self.dispatcher = Dispatcher(workers)
+        self.timeout = timeout
         super(Messenger, self).__init__(self.page_access_token)
+        self.client = MessengerClient(self.page_access_token, session=session or make_session(workers))
+
+    @property
+    def last_message(self):
+        
+        """Current message per thread, send() replies to its sender"""
+        
+        return getattr(self.local, 'last_message', {})
+
+    @last_message.setter
+    def last_message(self, message):
+        self.local.last_message = message
+
+    def handle(self, payload):
+        
+        """Handles all events of a webhook POST, senders in parallel, events of a sender in order"""
+        
+        senders = od()
+        for entry in payload['entry']:
+            for message in entry['messaging']:
+                senders.setdefault(message['sender']['id'], []).append(message)
+        
+        flask_app = app._get_current_object()
+        def handle_event(message):
+            with flask_app.app_context(), turn(), capture(message):
+                BaseMessenger.handle(self, {'entry': [{'messaging': [message]}]})
+        
+        self.dispatcher.run(handle_event, list(senders.values()))
+
+    @timed("send")
+    def send(self, payload, messaging_type, timeout=None, tag=None):
+        capture_reply(payload)
+        return self.client.send(payload, self.last_message, messaging_type,
+                                timeout=timeout or self.timeout, tag=tag)
+
+    def send_all(self, payloads, messaging_type='RESPONSE'):
+        
+        """Sends a multi-part reply in order over the pooled connection, stops at the first failure"""
+        
+        res = None
+        for payload in payloads:
+            res = self.send(payload, messaging_type)
+            if 'error' in res:
+                break
+        return res
 
     def message(self, message):
         response, callback = self.process_message(message)
         if callback:
-            response_info = self.generate_info_message()
-            res = self.send(response_info, 'RESPONSE')
-            res = self.send(response, 'RESPONSE')
+            res = self.send_all([self.generate_info_message(), response])
         else:
             res = self.send(response, 'RESPONSE')
-        app.logger.info('Response: {}'.format(res))
+        app.logger.debug('Response: {}'.format(res))
 
     def delivery(self, message):
         pass
@@ -120,12 +172,13 @@ class Messenger(BaseMessenger):
     def postback(self, message):
         user_id = message['sender']['id']
         payload = message['postback']['payload']
+        tag_intent("postback")
         
         if "WELCOME" in payload:
-            text = responses["welcome"][0]
-            self.handle_response(text)
-            text = responses["welcome"][1]
-            self.handle_response(text, ["Guided search", "Custom search", "More info"])
+            qrs = process_quick_rpls(["Guided search", "Custom search", "More info"])
+            res = self.send_all([Text(text=responses["welcome"][0]).to_dict(),
+                                 Text(text=responses["welcome"][1], quick_replies=qrs).to_dict()])
+            app.logger.debug('Response: {}'.format(res))
             
         if "RESTART" in payload:
             restart_msg = {'sender': {'id': message['sender']['id']},
@@ -154,7 +207,7 @@ class Messenger(BaseMessenger):
                                              get_started=get_started,
                                              greetings=[greeting_text])
         res = self.set_messenger_profile(messenger_profile.to_dict())
-        app.logger.info('Response: {}'.format(res))
+        app.logger.debug('Response: {}'.format(res))
         
         
         
@@ -162,24 +215,24 @@ class Messenger(BaseMessenger):
     
         """Handles message processing on the part of facebook"""
         
-        app.logger.info('Message received: {}'.format(message))
+        app.logger.debug('Message received: {}'.format(message))
         
         user_id = message['sender']['id']
         callback = False
         
         if "message" in message:
             if 'attachments' in message['message']:
-                print('entered')
                 response = Text(text="Apologies, but I'm only able to understand text input!")
                 return (response.to_dict(), callback)
             elif 'text' in message['message']:
                 message_text = message['message']['text']
+                payload = message['message'].get('quick_reply', {}).get('payload')
         
         elif "postback" in message:
             return self.postback(message)
         
         #run logic
-        text, quick_rpls, elastic_hits = detect_intent_texts(user_id, message_text)
+        text, quick_rpls, elastic_hits = detect_intent_texts(user_id, message_text, payload)
         
         if quick_rpls is None and elastic_hits is None:
             response = Text(text=text)
@@ -226,5 +279,5 @@ class Messenger(BaseMessenger):
         else:
             response = Text(text=text).to_dict()
         res = self.send(response, 'RESPONSE')
-        app.logger.info('Response: {}'.format(res))
+        app.logger.debug('Response: {}'.format(res))
         
@@ -0,0 +1,188 @@
+#Imports
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from contextlib import contextmanager
+
+#Modules
+from .md_config import keys
+
+enabled = keys.get('METRICS', False)
+
+#Histogram upper bounds in seconds
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self):
+
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, seconds):
+
+        self.counts[bisect_left(buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+
+class Registry:
+
+    """Latency histograms per (stage, intent) and stats of other components
+
+    Stages measured during a turn are buffered per thread and recorded when the turn ends,
+    by then the intent is known.
+    """
+
+    def __init__(self):
+
+        self.histograms = {}
+        self.collectors = {}
+        self.observers = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+    def record(self, stage, intent, seconds):
+
+        with self.lock:
+            histogram = self.histograms.get((stage, intent))
+            if histogram is None:
+                histogram = self.histograms[(stage, intent)] = Histogram()
+            histogram.observe(seconds)
+        for observer in self.observers:
+            observer(stage, intent, seconds)
+
+
+    def observe(self, stage, seconds):
+
+        observations = getattr(self.local, 'turn', None)
+        if observations is None:
+            self.record(stage, "none", seconds)
+        else:
+            observations.append((stage, seconds))
+
+
+    def tag(self, intent):
+        self.local.intent = intent
+
+
+    @contextmanager
+    def turn(self):
+
+        """Collects the stages of one dialog turn, records them with the turn's intent"""
+
+        self.local.turn = []
+        self.local.intent = "none"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            observations, self.local.turn = self.local.turn, None
+            observations.append(("turn", time.perf_counter() - start))
+            for stage, seconds in observations:
+                self.record(stage, self.local.intent, seconds)
+
+
+    @contextmanager
+    def timer(self, stage):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+
+    def register(self, name, stats, labels=None):
+
+        """Adds stats() of a component, its numeric values are exported as gauges
+
+        labels maps a stat to a label name, its value is a dict of {label value: number}.
+        """
+
+        self.collectors[name] = (stats, labels or {})
+
+
+    def render(self):
+
+        """Returns all metrics in Prometheus' text exposition format"""
+
+        with self.lock:
+            histograms = sorted((k, list(h.counts), h.sum, h.count) for k,h in self.histograms.items())
+
+        lines = ["# HELP chatbot_stage_seconds Latency of dialog turn stages by intent",
+                 "# TYPE chatbot_stage_seconds histogram"]
+        for (stage, intent), counts, total, count in histograms:
+            labels = 'stage="{}",intent="{}"'.format(stage, intent.replace('\\', '\\\\').replace('"', '\\"'))
+            cumulative = 0
+            for le, n in zip([str(b) for b in buckets] + ["+Inf"], counts):
+                cumulative += n
+                lines.append('chatbot_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, cumulative))
+            lines.append('chatbot_stage_seconds_sum{{{}}} {}'.format(labels, total))
+            lines.append('chatbot_stage_seconds_count{{{}}} {}'.format(labels, count))
+
+        number = lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)
+        for name, (stats, labels) in sorted(self.collectors.items()):
+            for k,v in sorted(stats().items()):
+                metric = "chatbot_{}_{}".format(name, k)
+                if k in labels and isinstance(v, dict):
+                    lines.append("# TYPE {} gauge".format(metric))
+                    lines += ['{}{{{}="{}"}} {}'.format(metric, labels[k], label, n)
+                              for label, n in sorted(v.items()) if number(n)]
+                elif number(v):
+                    lines += ["# TYPE {} gauge".format(metric), "{} {}".format(metric, v)]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+
+
+
+################# Instrumentation ##########################
+
+class NullTimer:
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+null_timer = NullTimer()
+
+
+def timer(stage):
+
+    """Context manager timing a stage, a shared no-op when metrics are disabled"""
+
+    return metrics.timer(stage) if enabled else null_timer
+
+
+def timed(stage):
+
+    """Decorator timing every call as stage, leaves the function untouched when disabled"""
+
+    def decorate(fn):
+        if not enabled:
+            return fn
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def turn():
+    return metrics.turn() if enabled else null_timer
+
+
+def tag(intent):
+    if enabled:
+        metrics.tag(intent)
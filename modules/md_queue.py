@@ -0,0 +1,195 @@
+#Imports
+import os
+import atexit
+import queue
+import logging
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+
+    """Queues of webhook events drained by worker threads, holding at most size events each
+
+    Events already acknowledged to Facebook are not retried by it, so a full queue rejects
+    new events instead of growing and close() processes the queued ones before exiting.
+    """
+
+    def __init__(self, handler, workers=4, size=100):
+
+        self.handler = handler
+        self.workers = workers
+        self.size = size
+        self.queues = []
+        self.threads = []
+        self.closed = False
+        self.rejected = 0
+        self.pid = None
+        self.lock = threading.Lock()
+
+
+    def start(self):
+
+        """Starts worker threads, restarts them after a fork (e.g. gunicorn --preload)"""
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queues = [queue.Queue() for _ in range(self.workers)]
+            self.threads = []
+            for i, q in enumerate(self.queues):
+                worker = threading.Thread(target=self.work, args=(q,),
+                                          name="webhook-worker-{}".format(i))
+                worker.daemon = True
+                worker.start()
+                self.threads.append(worker)
+            self.closed = False
+            self.pid = os.getpid()
+        atexit.register(self.close)
+
+
+    def put(self, items):
+
+        """Enqueues (key, item) pairs, items with the same key are always handled by the same worker
+
+        Returns False without enqueuing any item when closed or a queue would exceed size.
+        """
+
+        if self.pid != os.getpid():
+            self.start()
+        targets = [self.queues[zlib.crc32(str(key).encode("utf-8")) % len(self.queues)] for key, _ in items]
+        with self.lock:
+            counts = {}
+            for q in targets:
+                counts[q] = counts.get(q, 0) + 1
+            if self.closed or any(q.qsize() + n > self.size for q, n in counts.items()):
+                self.rejected += len(items)
+                return False
+            for q, (_, item) in zip(targets, items):
+                q.put(item)
+        return True
+
+
+    def work(self, q):
+
+        """Drains one queue until close(), a failing item must not stop the worker"""
+
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            try:
+                self.handler(item)
+            except Exception:
+                logger.exception("Failed to process queued event.")
+            finally:
+                q.task_done()
+
+
+    def close(self, timeout=20):
+
+        """Stops accepting items and waits up to timeout seconds for the queued ones, returns True if all were processed"""
+
+        with self.lock:
+            if self.pid != os.getpid() or self.closed:
+                return True
+            self.closed = True
+            for q in self.queues:
+                q.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.threads:
+            worker.join(max(0, deadline - time.monotonic()))
+        left = sum(q.qsize() for q in self.queues)
+        if left:
+            logger.warning("{} queued events not processed at shutdown.".format(left))
+        return not left
+
+
+    def join(self):
+
+        """Blocks until all queued items are processed"""
+
+        for q in self.queues:
+            q.join()
+
+
+    def stats(self):
+
+        with self.lock:
+            return {'queued': sum(q.qsize() for q in self.queues), 'rejected': self.rejected}
+
+
+
+class Dispatcher:
+
+    def __init__(self, workers=8):
+
+        self.workers = workers
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.dispatched = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+
+    def get_pool(self):
+
+        """Returns thread pool, created lazily per process"""
+
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+                self.pid = os.getpid()
+            return self.pool
+
+
+    def run(self, handler, groups):
+
+        """Runs handler over the items of each group in order, groups in parallel, waits for all"""
+
+        if len(groups) == 1:
+            return self.run_group(handler, groups[0], time.monotonic())
+
+        pool = self.get_pool()
+        futures = [pool.submit(self.run_group, handler, items, time.monotonic()) for items in groups]
+        errors = [f.exception() for f in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+
+    def run_group(self, handler, items, submitted):
+
+        """Handles one group, records queueing delay and concurrency"""
+
+        delay = time.monotonic() - submitted
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.dispatched += 1
+            self.delay_total += delay
+            self.delay_max = max(self.delay_max, delay)
+        try:
+            for item in items:
+                handler(item)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+    def stats(self):
+
+        with self.lock:
+            return {'active': self.active,
+                    'peak': self.peak,
+                    'dispatched': self.dispatched,
+                    'queue_delay_avg': self.delay_total / self.dispatched if self.dispatched else 0.0,
+                    'queue_delay_max': self.delay_max}
@@ -1,27 +1,362 @@
 #Imports
 import redis
 import pickle
+import zlib
+import io
 import os
 import json
+import time
+import threading
 
-#Connection
-with open("config/keys.json") as f:
-    redis_host = json.load(f)['REDIS_HOST']
-r = redis.StrictRedis(host=redis_host, port=6379)
+#Modules
+from .md_config import keys, Lazy
+from .md_cache import LRUCache
+from .md_metrics import timed
+
+#Connection, opened by the first command, an unreachable Redis fails commands instead of hanging
+redis_host = keys['REDIS_HOST']
+r = Lazy(lambda: redis.StrictRedis(host=redis_host, port=6379,
+                                   socket_connect_timeout=keys.get('REDIS_CONNECT_TIMEOUT', 2),
+                                   socket_timeout=keys.get('REDIS_TIMEOUT', 5)))
+
+#Session encoding: b'J'/b'Z' (plain/zlib JSON) + schema version
+session_version = 1
+plain_prefix = b'J' + bytes([session_version])
+session_ttl = 1800 #expire after 30mins
+compress_threshold = 1024
+
+#Sessions are hashes, one field per value, nested fields are split per key
+nested_fields = ('search-params',)
+version_field = '_ver'
+
+
+class Session(dict):
+    
+    """Session state remembering the encoded fields it was loaded with"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loaded = {}
+        self.version = None
+        self.legacy = False
+
+
+class SessionUnpickler(pickle.Unpickler):
+    
+    """Reads sessions pickled by earlier releases, refuses anything but plain data"""
+    
+    def find_class(self, module, name):
+        if (module, name) == ("collections", "OrderedDict"):
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError("Refusing to load {}.{}".format(module, name))
+
+
+#Encode/Decode
+def encode_session(obj):
+    data = json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode("utf-8")
+    if len(data) > compress_threshold:
+        return b'Z' + bytes([session_version]) + zlib.compress(data, 1)
+    return b'J' + bytes([session_version]) + data
+
+def decode_session(data):
+    if data[:1] in (b'Z', b'J'):
+        if data[1] != session_version:
+            raise ValueError("Unknown session schema version {}".format(data[1]))
+        if data[:1] == b'Z':
+            return json.loads(zlib.decompress(data[2:]).decode("utf-8"))
+        return json.loads(data[2:].decode("utf-8"))
+    return SessionUnpickler(io.BytesIO(data)).load()
+
+
+def flatten(obj):
+    
+    """Encodes state into hash fields, e.g. search-params.meal"""
+    
+    fields = {}
+    for k,v in obj.items():
+        if k in nested_fields:
+            for sub, value in v.items():
+                fields["{}.{}".format(k, sub)] = encode_session(value)
+        else:
+            fields[k] = encode_session(v)
+    return fields
+
+def unflatten(items, session):
+    
+    """Decodes hash fields into session, plain JSON fields are parsed in one go"""
+    
+    items = list(items)
+    plain = [value[2:] for _, value in items if value[:2] == plain_prefix]
+    values = iter(json.loads((b"[" + b",".join(plain) + b"]").decode("utf-8")) if plain else [])
+    for field, value in items:
+        value = next(values) if value[:2] == plain_prefix else decode_session(value)
+        k, _, sub = field.partition(".")
+        if sub:
+            session.setdefault(k, {})[sub] = value
+        else:
+            session[field] = value
+    return session
+
+
+def new_version():
+    
+    """Random stamp of a session write, never reused unlike a counter restarting with the hash"""
+    
+    return int.from_bytes(os.urandom(8), "big") >> 1
+
+
+#Process-local session cache in front of Redis, entries carry the _ver stamp of the hash:
+#"versioned" drops entries written by other processes (announced over pub/sub),
+#"local" trusts the cache (requires user affinity)
+session_cache_mode = keys.get('SESSION_CACHE')
+session_cache = None
+if session_cache_mode:
+    session_cache = LRUCache(maxsize=100000, ttl=session_ttl,
+                             max_weight=keys.get('SESSION_CACHE_BYTES', 16*1024*1024),
+                             weigh=lambda entry: 200 + sum(len(v or b'') for v in entry['fields'].values()))
+
+#Channel announcing session writes, messages are "<origin> <key>"
+invalidation_channel = "session-writes"
+
+
+class Invalidations:
+    
+    """Drops cached sessions when another process writes them
+    
+    A daemon thread per process listens on invalidation_channel. Cached sessions are only
+    served while it is subscribed, everything cached before a (re)subscription is dropped.
+    Reads and writes started before an invalidation arrived are not cached.
+    """
+    
+    def __init__(self, cache):
+        
+        self.cache = cache
+        self.pid = None
+        self.origin = None
+        self.ready = False
+        self.generation = 0
+        self.lock = threading.Lock()
+    
+    
+    def start(self):
+        
+        """Starts the listener once per process, returns True while it is subscribed"""
+        
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.origin = "{}-{}".format(self.pid, os.urandom(4).hex())
+                    self.ready = False
+                    threading.Thread(target=self.listen, daemon=True).start()
+        return self.ready
+    
+    
+    def reset(self, ready):
+        
+        with self.lock:
+            self.ready = ready
+            self.generation += 1
+            self.cache.invalidate()
+    
+    
+    def listen(self):
+        
+        while True:
+            pubsub = None
+            try:
+                pubsub = r.pubsub()
+                pubsub.subscribe(invalidation_channel)
+                #polls, a blocking read would hit the socket timeout on a quiet channel
+                while True:
+                    message = pubsub.get_message(timeout=1)
+                    if message is None:
+                        continue
+                    if message['type'] == 'subscribe':
+                        self.reset(True)
+                    elif message['type'] == 'message':
+                        origin, _, key = message['data'].decode("utf-8").partition(" ")
+                        if origin != self.origin:
+                            with self.lock:
+                                self.generation += 1
+                            self.cache.delete(key)
+            except Exception:
+                self.reset(False)
+                time.sleep(1)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+    
+    
+    def announce(self, pipe, key):
+        self.start()
+        pipe.publish(invalidation_channel, "{} {}".format(self.origin, key))
+
+
+invalidations = Invalidations(session_cache) if session_cache_mode == "versioned" else None
+
+
+def cache_generation():
+    return invalidations.generation if invalidations else 0
+
+def cache_store(key, version, known, complete=False, ttl=None, base=None, generation=0):
+    
+    """Merges known fields (None for missing ones) into the cached entry they were read from or written on
+    
+    base is the stamp a partial write was based on, generation the cache generation when the
+    read or write started, the entry is dropped if an invalidation arrived since.
+    """
+    
+    if invalidations and (not invalidations.ready or generation != invalidations.generation):
+        session_cache.delete(key)
+        return
+    entry = session_cache.peek(key)
+    fields = {}
+    if entry and entry['version'] in (version, base):
+        fields = dict(entry['fields'])
+        complete = complete or entry['complete']
+    fields.update(known)
+    session_cache.set(key, {'version': version, 'fields': fields, 'complete': complete}, ttl)
+
+def cache_lookup(key, fields):
+    
+    """Returns (items, version) if all requested fields are cached and current, None otherwise"""
+    
+    if invalidations and not invalidations.start():
+        return None
+    entry = session_cache.get(key)
+    if entry is None:
+        return None
+    if fields is None:
+        if not entry['complete']:
+            return None
+        items = list(entry['fields'].items())
+    elif all(f in entry['fields'] for f in fields):
+        items = [(f, entry['fields'][f]) for f in fields]
+    else:
+        return None
+    return ([(f, v) for f,v in items if v is not None], entry['version'])
+
+def make_session(items, version=None):
+    session = unflatten(items, Session())
+    session.loaded = dict(items)
+    session.version = version
+    return session
 
 
 #Set/Get/Del
+@timed("redis_set")
 def redis_set(key, obj):
-    pickled_object = pickle.dumps(obj)
-    r.set(key, pickled_object)
-    r.expire(key, 1800) #expire after 30mins
+    
+    """Writes changed fields, version stamp and TTL in one transaction"""
+    
+    fields = flatten(obj)
+    loaded = getattr(obj, 'loaded', None)
+    full = loaded is None or obj.legacy
+    if full:
+        changed, removed = fields, []
+    else:
+        changed = {f: v for f,v in fields.items() if loaded.get(f) != v}
+        removed = [f for f in loaded if f not in fields]
+    
+    version = new_version()
+    generation = cache_generation()
+    pipe = r.pipeline()
+    if full:
+        pipe.delete(key)
+    pipe.hmset(key, dict(changed, **{version_field: version}))
+    if removed:
+        pipe.hdel(key, *removed)
+    pipe.expire(key, session_ttl)
+    if invalidations:
+        invalidations.announce(pipe, key)
+    pipe.execute()
+    
+    if session_cache:
+        known = dict(changed, **{f: None for f in removed}) if not full else fields
+        cache_store(key, version, known, complete=full, base=None if full else obj.version,
+                    generation=generation)
+    if isinstance(obj, Session):
+        obj.loaded = fields if full else {f: v for f,v in fields.items()
+                                          if f in loaded or f in changed}
+        obj.version = version
+        obj.legacy = False
 
-def redis_get(key):
-    res = r.get(key)
-    if res is None:
-        return None
+@timed("redis_get")
+def redis_get(key, fields=None):
+    
+    """Reads all or only the given hash fields, returns None for missing sessions"""
+    
+    if session_cache:
+        cached = cache_lookup(key, fields)
+        if cached is not None:
+            items, version = cached
+            return make_session(items, version) if items else None
+    
+    generation = cache_generation()
+    pipe = r.pipeline(transaction=False)
+    if fields is None:
+        pipe.hgetall(key)
     else:
-        return pickle.loads(res)
+        pipe.hmget(key, list(fields) + [version_field])
+    pipe.pttl(key)
+    try:
+        res, ttl = pipe.execute()
+    except redis.exceptions.ResponseError:
+        #session written by an earlier release as a single string
+        res = r.get(key)
+        if res is None:
+            return None
+        session = Session(decode_session(res))
+        session.legacy = True
+        return session
+    
+    if fields is None:
+        known = {f.decode("utf-8"): v for f,v in res.items()}
+        version = known.pop(version_field, None)
+    else:
+        version = res.pop()
+        known = dict(zip(fields, res))
+    version = int(version) if version is not None else None
+    if session_cache and version is not None:
+        cache_store(key, version, known, complete=fields is None,
+                    ttl=ttl / 1000 if ttl and ttl > 0 else None, generation=generation)
+    
+    items = [(f, v) for f,v in known.items() if v is not None]
+    return make_session(items, version) if items else None
+
+@timed("redis_get")
+def redis_fill(key, session, fields):
+    
+    """Loads further fields into a session read before"""
+    
+    #sessions of earlier releases are single strings and were decoded completely
+    if getattr(session, 'legacy', False):
+        return
+    cached = session_cache and cache_lookup(key, fields)
+    if cached:
+        items = cached[0]
+    else:
+        generation = cache_generation()
+        res = r.hmget(key, list(fields) + [version_field])
+        version = res.pop()
+        if session_cache and version is not None:
+            cache_store(key, int(version), dict(zip(fields, res)), generation=generation)
+        items = [(f, v) for f,v in zip(fields, res) if v is not None]
+    unflatten(items, session)
+    if isinstance(session, Session):
+        session.loaded.update(items)
+
+def redis_exists(key):
+    if session_cache_mode == "local" and session_cache.peek(key):
+        return True
+    return r.exists(key) > 0
 
 def redis_delete(key):
-    r.delete(key)
+    pipe = r.pipeline()
+    pipe.delete(key)
+    if invalidations:
+        invalidations.announce(pipe, key)
+    pipe.execute()
+    if session_cache:
+        session_cache.delete(key)
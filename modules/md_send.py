@@ -0,0 +1,52 @@
+#Imports
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+graph_url = "https://graph.facebook.com"
+
+#A 500/502/504 may come after the message was delivered, retrying would send it twice.
+#429 is always refused unprocessed, urllib3 also retries 503 (and 413) when it carries Retry-After
+retry_statuses = (429,)
+
+
+def make_retry(retries, backoff):
+
+    """Retries connection errors, 429 and 503 answers with Retry-After, never a request the Send API may have processed"""
+
+    options = dict(total=retries, connect=retries, read=0, status=retries,
+                   status_forcelist=retry_statuses, backoff_factor=backoff,
+                   respect_retry_after_header=True, raise_on_status=False)
+    try:
+        return Retry(allowed_methods=frozenset(["GET", "POST"]), **options)
+    except TypeError:
+        #urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(["GET", "POST"]), **options)
+
+
+class GraphAdapter(HTTPAdapter):
+
+    """Sends Graph API requests to base_url instead, e.g. a local sink in load tests"""
+
+    def __init__(self, base_url, **kwargs):
+
+        self.base_url = base_url.rstrip("/")
+        super(GraphAdapter, self).__init__(**kwargs)
+
+
+    def send(self, request, **kwargs):
+
+        request.url = self.base_url + request.url[len(graph_url):]
+        return super(GraphAdapter, self).send(request, **kwargs)
+
+
+
+def make_session(pool_size=10, retries=3, backoff=0.3, base_url=None):
+
+    """Returns Graph API session keeping pool_size connections alive across requests"""
+
+    session = requests.Session()
+    options = dict(pool_connections=1, pool_maxsize=pool_size, max_retries=make_retry(retries, backoff))
+    adapter = GraphAdapter(base_url, **options) if base_url else HTTPAdapter(**options)
+    session.mount(graph_url, adapter)
+    return session
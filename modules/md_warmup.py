@@ -0,0 +1,101 @@
+#Imports
+import time
+import logging
+import threading
+from collections import OrderedDict as od
+
+#Modules
+from .md_config import keys
+from .md_redis import r
+from .md_elasticsearch import Elastic, es, detail_store
+from .md_dialog_logic import entities, window_size
+from .md_dialogflow import sessions
+
+logger = logging.getLogger(__name__)
+
+#Canned searches, their results also fill the search cache
+warmup_searches = keys.get('WARMUP_SEARCHES', [{"meal": ["Main"]}])
+
+lock = threading.Lock()
+last_report = None
+start_lock = threading.Lock()
+running = None
+
+
+def canned_state(params):
+
+    search_params = od((e, []) if e == "avoid" else (e, [None]) for e in entities)
+    search_params.update(params)
+    return {'search-params': search_params, 'search_batch': 0}
+
+
+def warm_search():
+
+    #loads the local snapshot or opens the Elasticsearch pool
+    es.resolve()
+    elastic = Elastic()
+    for params in warmup_searches:
+        elastic.search(canned_state(params), size=window_size)
+    if detail_store:
+        detail_store.warm()
+
+
+def warm_dialogflow():
+
+    if not sessions.health_check(keys.get('WARMUP_TIMEOUT', 5)):
+        raise RuntimeError("Dialogflow channels not ready")
+
+
+#Steps in order, each opens and verifies one backend
+steps = od([("redis", lambda: r.ping()),
+            ("search", warm_search),
+            ("dialogflow", warm_dialogflow)])
+
+
+def warmup():
+
+    """Connects to all backends and runs the canned searches once per process
+
+    Returns {step: {"ok": ..., "ms": ...}}, failed steps are retried on the next call.
+    """
+
+    global last_report
+    with lock:
+        if last_report and all(step['ok'] for step in last_report.values()):
+            return last_report
+
+        report = od()
+        for name, step in steps.items():
+            start = time.perf_counter()
+            try:
+                step()
+                report[name] = {'ok': True}
+            except Exception as e:
+                logger.exception("Warmup step {} failed.".format(name))
+                report[name] = {'ok': False, 'error': repr(e)}
+            report[name]['ms'] = round((time.perf_counter() - start) * 1000, 1)
+        last_report = report
+        return report
+
+
+def ready():
+    return bool(last_report) and all(step['ok'] for step in last_report.values())
+
+
+def start(callback=None):
+
+    """Runs warmup in a background thread unless it succeeded or is running, returns at once
+
+    callback receives the report. Each step is bounded by its client's timeouts.
+    """
+
+    global running
+    with start_lock:
+        if ready() or (running and running.is_alive()):
+            return
+        def run():
+            report = warmup()
+            if callback:
+                callback(report)
+        running = threading.Thread(target=run, name="warmup", daemon=True)
+        running.start()
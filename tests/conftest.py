@@ -0,0 +1,47 @@
+"""Runs the tests from a temporary working directory with its own config/keys.json.
+
+Modules read config/keys.json and data/ relative to the working directory when they are
+imported, so this happens before any test module is collected. Run from the repository root:
+
+    python -m pytest tests
+"""
+
+#Imports
+import os
+import sys
+import json
+import tempfile
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+keys = {"FLASK_SECRET_KEY": "test", "FB_ACCESS_TOKEN": "test", "FB_VERIFY_TOKEN": "test",
+        "DIALOGFLOW_PROJECT_ID": "test", "REDIS_HOST": "localhost",
+        "ELASTIC_HOST": os.environ.get("ELASTIC_TEST_HOST", "localhost"), "SEARCH_BACKEND": "local"}
+
+workdir = tempfile.mkdtemp(prefix="tests-")
+os.makedirs(os.path.join(workdir, "config"))
+os.symlink(os.path.join(root, "data"), os.path.join(workdir, "data"))
+with open(os.path.join(workdir, "config", "keys.json"), "w") as f:
+    json.dump(keys, f)
+os.chdir(workdir)
+sys.path.insert(0, root)
+
+
+@pytest.fixture(scope="session")
+def recipes():
+
+    """Synthetic snapshot documents, as loaded by the benchmark harness"""
+
+    from benchmarks.harness import synthetic_recipes
+    return list(synthetic_recipes(2000))
+
+
+@pytest.fixture(scope="session")
+def local(recipes):
+
+    """LocalSearch over the synthetic recipes, keeping the fields the app loads"""
+
+    from modules.md_local_search import LocalSearch
+    from modules.md_elasticsearch import Elastic, source_fields
+    return LocalSearch(recipes, source_fields + ["rating", "recomm_perc"], Elastic().get_display)
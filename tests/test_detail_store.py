@@ -0,0 +1,54 @@
+#Imports
+import pytest
+
+#Modules
+from modules.md_detail_store import DetailStore, build
+from modules.md_elasticsearch import Elastic
+
+
+@pytest.fixture(scope="module")
+def store(recipes, tmp_path_factory):
+
+    path = str(tmp_path_factory.mktemp("details") / "recipe_details.bin")
+    assert build(((doc["_id"], doc["_source"]) for doc in recipes), Elastic().render_details, path) == len(recipes)
+    store = DetailStore(path)
+    yield store
+    store.close()
+
+
+def test_matches_render_details(store, recipes):
+
+    elastic = Elastic()
+    for doc in recipes[::37] + recipes[-1:]:
+        for field in ["ingredients", "nutrients"]:
+            assert store.get(doc["_id"], field) == elastic.render_details(doc["_source"], field)
+
+
+def test_missing_recipe(store):
+
+    assert store.find("recipe-unknown") is None
+    assert store.get("recipe-unknown", "ingredients") is None
+
+
+def test_rejects_other_files(tmp_path):
+
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        DetailStore(str(path))
+
+
+def test_falls_back_to_documents(tmp_path, monkeypatch, recipes):
+
+    from modules import md_elasticsearch
+    from modules.md_local_search import LocalSearch
+
+    #recipes indexed after the store was built are fetched and rendered
+    path = str(tmp_path / "recipe_details.bin")
+    build(((doc["_id"], doc["_source"]) for doc in recipes[:10]), Elastic().render_details, path)
+    store = DetailStore(path)
+    monkeypatch.setattr(md_elasticsearch, "detail_store", store)
+    elastic = Elastic(LocalSearch(recipes[:20]))
+    for doc in [recipes[3], recipes[15]]:
+        assert elastic.get_recipe_details(doc["_id"], "nutrients") == elastic.render_details(doc["_source"], "nutrients")
+    store.close()
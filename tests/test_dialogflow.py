@@ -0,0 +1,51 @@
+#Imports
+import pytest
+
+#Modules
+from modules.md_dialogflow import SessionsClientPool
+from modules.md_metrics import Registry
+
+
+class Channel:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_exports_reuse_per_channel():
+
+    pool = SessionsClientPool(2, factory=lambda: (object(), None))
+    for _ in range(5):
+        pool.get()
+    registry = Registry()
+    registry.register('dialogflow', pool.stats, {'channel_reuse': 'channel'})
+    lines = registry.render().splitlines()
+    assert 'chatbot_dialogflow_active_channels 2' in lines
+    assert 'chatbot_dialogflow_channel_reuse{channel="0"} 3' in lines
+    assert 'chatbot_dialogflow_channel_reuse{channel="1"} 2' in lines
+
+
+def test_health_check_closes_replaced_channels(monkeypatch):
+
+    grpc = pytest.importorskip("grpc")
+    channels = []
+    def factory():
+        channels.append(Channel())
+        return (object(), channels[-1])
+
+    class Future:
+        def __init__(self, channel):
+            self.channel = channel
+        def result(self, timeout=None):
+            #the first channel never gets ready
+            if self.channel is channels[0]:
+                raise grpc.FutureTimeoutError()
+
+    monkeypatch.setattr(grpc, "channel_ready_future", Future)
+    pool = SessionsClientPool(2, factory=factory)
+    assert not pool.health_check(timeout=0.1)
+    assert channels[0].closed and not channels[1].closed
+    assert [channel for _, channel in pool.clients] == [channels[2], channels[1]]
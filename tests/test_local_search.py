@@ -0,0 +1,92 @@
+#Imports
+import os
+import pytest
+
+#Modules
+from modules.md_local_search import compare
+from modules.md_elasticsearch import source_fields
+
+
+@pytest.fixture
+def remote(recipes):
+
+    """Index of the synthetic recipes on the Elasticsearch 6 cluster at ELASTIC_TEST_HOST"""
+
+    host = os.environ.get("ELASTIC_TEST_HOST")
+    if not host:
+        pytest.skip("ELASTIC_TEST_HOST not set")
+    from elasticsearch import Elasticsearch
+    from elasticsearch.helpers import bulk
+
+    client = Elasticsearch("http://{}:9200".format(host))
+    index = "recipes-test-{}".format(os.getpid())
+    client.indices.create(index, body={"settings": {"number_of_shards": 1}})
+    try:
+        bulk(client, ({"_index": index, "_type": "recipe", "_id": doc["_id"], "_source": doc["_source"]}
+                      for doc in recipes), refresh=True)
+        yield (client, index)
+    finally:
+        client.indices.delete(index)
+
+
+def test_keeps_only_hit_fields(local):
+
+    source = local.get("recipes", "recipe-1")["_source"]
+    assert set(source) <= set(source_fields + ["rating", "recomm_perc"])
+    assert "ingredients" not in source and "categories" not in source
+    assert set(source["display"]) == {"subtitle", "image_url"}
+
+
+def test_categories_rebuilt_from_bitmaps(local, recipes):
+
+    categories = {k: sorted(v) for k,v in recipes[7]["_source"]["categories"].items() if v}
+    position = local.positions[recipes[7]["_id"]]
+    assert {k: sorted(v) for k,v in local.categories(position).items()} == categories
+
+
+def term(category, value):
+    return {"term": {"categories.{}.keyword".format(category): {"value": value}}}
+
+
+def matching(local, query):
+    return {hit["_id"] for hit in local.search(body={"size": len(local.ids), "query": query})["hits"]["hits"]}
+
+
+def has(doc, category, value):
+    return value in (doc["_source"]["categories"].get(category) or [])
+
+
+def test_bool_must_should_must_not(local, recipes):
+
+    rice, chicken = term("ingredient", "Rice"), term("ingredient", "Chicken")
+    main, nut_free = term("meal", "Main"), term("special", "Nut Free")
+
+    #must: all clauses match, should alone: any clause matches, must_not: none matches
+    assert matching(local, {"bool": {"must": [rice, main]}}) == \
+        {doc["_id"] for doc in recipes if has(doc, "ingredient", "Rice") and has(doc, "meal", "Main")}
+    assert matching(local, {"bool": {"should": [rice, chicken]}}) == \
+        {doc["_id"] for doc in recipes if has(doc, "ingredient", "Rice") or has(doc, "ingredient", "Chicken")}
+    assert matching(local, {"bool": {"must": [main], "must_not": [rice]}}) == \
+        {doc["_id"] for doc in recipes if has(doc, "meal", "Main") and not has(doc, "ingredient", "Rice")}
+
+    #should next to must only scores, it does not filter
+    assert matching(local, {"bool": {"must": [main], "should": [nut_free]}}) == matching(local, {"bool": {"must": [main]}})
+    #partial matches: any clause but not all of them
+    partial = matching(local, {"bool": {"should": [rice, main], "must_not": [{"bool": {"must": [rice, main]}}]}})
+    assert partial == {doc["_id"] for doc in recipes
+                       if has(doc, "ingredient", "Rice") != has(doc, "meal", "Main")}
+
+
+def test_ranks_more_matching_clauses_first(local):
+
+    res = local.search(body={"size": 50, "query": {"bool": {"should": [term("meal", "Main"), term("ingredient", "Rice")]}},
+                             "sort": [{"_score": "desc"}, {"_id": "asc"}]})
+    hits = res["hits"]["hits"]
+    assert [hit["sort"] for hit in hits] == sorted((hit["sort"] for hit in hits), key=lambda s: (-s[0], s[1]))
+    assert {hit["_id"] for hit in hits[:5]} <= matching(local, {"bool": {"must": [term("meal", "Main"), term("ingredient", "Rice")]}})
+
+
+def test_matches_elasticsearch(local, remote):
+
+    client, index = remote
+    assert compare(local, client, runs=50, index=index) == []
@@ -0,0 +1,57 @@
+#Imports
+import time
+import threading
+
+#Modules
+from modules.md_queue import WorkQueue
+
+
+def test_keeps_order_per_sender():
+
+    handled = []
+    work_queue = WorkQueue(lambda item: handled.append(item), workers=4)
+    assert work_queue.put([(i % 5, (i % 5, i)) for i in range(200)])
+    work_queue.join()
+    for sender in range(5):
+        assert [i for s, i in handled if s == sender] == list(range(sender, 200, 5))
+    assert work_queue.close()
+
+
+def test_rejects_batch_when_full():
+
+    release = threading.Event()
+    handled = []
+    def handler(item):
+        release.wait()
+        handled.append(item)
+    work_queue = WorkQueue(handler, workers=1, size=3)
+    assert work_queue.put([("a", 1)])
+    #the worker holds item 1, the queue takes 3 more
+    time.sleep(0.05)
+    assert work_queue.put([("a", 2), ("b", 3)])
+    assert not work_queue.put([("a", 4), ("b", 5)])
+    assert work_queue.put([("a", 6)])
+    assert work_queue.stats() == {'queued': 3, 'rejected': 2}
+    release.set()
+    work_queue.join()
+    assert handled == [1, 2, 3, 6]
+    assert work_queue.close()
+
+
+def test_close_processes_queued_items():
+
+    handled = []
+    work_queue = WorkQueue(lambda item: (time.sleep(0.01), handled.append(item)), workers=2)
+    assert work_queue.put([(i, i) for i in range(20)])
+    assert work_queue.close(timeout=5)
+    assert sorted(handled) == list(range(20))
+    assert not work_queue.put([("late", 1)])
+
+
+def test_close_gives_up_after_timeout():
+
+    release = threading.Event()
+    work_queue = WorkQueue(lambda item: release.wait(), workers=1)
+    work_queue.put([("a", 1), ("a", 2)])
+    assert not work_queue.close(timeout=0.1)
+    release.set()
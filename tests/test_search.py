@@ -0,0 +1,76 @@
+#Imports
+import pytest
+
+#Modules
+from modules import md_elasticsearch
+from modules.md_elasticsearch import Elastic, hit_cache, filter_values
+
+
+def test_window_hits_from_ids(local):
+
+    elastic = Elastic(local)
+    hits, _ = elastic.search({'search-params': {'meal': ["Main"], 'avoid': []}}, size=5)
+    entries = [[hit.id, hit.exact] for hit in hits]
+    assert elastic.get_hits(entries) == hits
+
+    #other workers fetch the carousel fields with one _mget
+    hit_cache.invalidate()
+    assert elastic.get_hits(entries) == hits
+    #windows of earlier releases held whole hits, recipes no longer indexed are skipped
+    assert elastic.get_hits([list(hits[0]), ["missing", True]]) == hits[:1]
+
+
+def test_filter_values():
+
+    assert filter_values([None]) is None and filter_values([]) is None
+    #difficulty "Normal" means no preference
+    assert filter_values(["Easy", "Normal"]) is None
+    #"Long" recipes include the "Standard" ones
+    assert filter_values(["Long"]) == ["Long", "Standard"]
+    assert filter_values(["Standard", "Long"]) == ["Standard", "Long"]
+    assert filter_values(["Quick"]) == ["Quick"]
+
+
+def test_build_query():
+
+    params = {'meal': ["Main"], 'time': ["Long"], 'difficulty': ["Normal"], 'ingredient': ["Rice"],
+              'special': [None], 'avoid': ["Chicken"]}
+    bools = Elastic().build_query({'search-params': params})
+    terms = lambda query, category, values: {"bool": {query: [
+        {"term": {"categories.{}.keyword".format(category): {"value": v}}} for v in values]}}
+    assert bools == [terms("should", "meal", ["Main"]), terms("should", "time", ["Long", "Standard"]),
+                     terms("must", "ingredient", ["Rice"]), terms("must_not", "ingredient", ["Chicken"])]
+    #the session keeps the values the user asked for
+    assert params['time'] == ["Long"]
+
+
+@pytest.fixture
+def uncached(monkeypatch):
+    monkeypatch.setattr(md_elasticsearch, "search_cache", None)
+
+
+@pytest.mark.parametrize("ranking", ["cascade", "boosted"])
+@pytest.mark.parametrize("params", [
+    {'meal': ["Main"], 'time': ["Quick"], 'ingredient': ["Rice"], 'avoid': []},
+    {'meal': ["Dessert"], 'time': ["Long"], 'difficulty': ["Easy"], 'avoid': ["Chicken"]},
+])
+def test_cursor_pages_match_one_query(local, uncached, monkeypatch, ranking, params):
+
+    monkeypatch.setattr(md_elasticsearch, "ranking", ranking)
+    state_dict = {'search-params': params}
+    expected, _ = Elastic(local).search(state_dict, size=local.count)
+
+    pages = []
+    elastic = Elastic(local)
+    cursor = None
+    while True:
+        hits, _ = elastic.search(state_dict, size=7, cursor=cursor)
+        pages += hits
+        cursor = elastic.cursor
+        if cursor is None:
+            break
+        assert len(hits) == 7
+    #no duplicates, gaps or reordering across pages, exact matches first
+    assert [hit.id for hit in pages] == [hit.id for hit in expected]
+    assert [hit.exact for hit in pages] == sorted((hit.exact for hit in pages), reverse=True)
+    assert [hit.exact for hit in pages] == [hit.exact for hit in expected]
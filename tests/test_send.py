@@ -0,0 +1,51 @@
+#Imports
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+#Modules
+from modules.md_send import make_session, graph_url
+
+
+@pytest.fixture
+def graph():
+
+    """Local Send API answering POSTs with the queued (status, headers) answers, then 200"""
+
+    requests = []
+    answers = []
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            requests.append(self.path)
+            status, headers = answers.pop(0) if answers else (200, {})
+            self.send_response(status)
+            for k,v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(server.server_port), requests, answers
+    server.shutdown()
+
+
+@pytest.mark.parametrize("answer, attempts", [
+    ((429, {}), 2),
+    ((503, {"Retry-After": "0"}), 2),
+    ((503, {}), 1),
+    ((500, {}), 1),
+    ((502, {}), 1),
+    ((504, {}), 1),
+])
+def test_retries_only_unprocessed_posts(graph, answer, attempts):
+
+    url, requests, answers = graph
+    answers.append(answer)
+    session = make_session(retries=3, backoff=0, base_url=url)
+    res = session.post(graph_url + "/v2.6/me/messages", json={"message": {"text": "hi"}})
+    assert len(requests) == attempts
+    assert res.status_code == (200 if attempts == 2 else answer[0])
@@ -0,0 +1,86 @@
+#Imports
+import os
+import pickle
+import pytest
+from collections import OrderedDict as od
+
+#Modules
+from modules import md_redis
+from modules.md_redis import encode_session, decode_session, flatten, unflatten, Session, session_version
+
+
+params = od([("meal", ["Main"]), ("time", ["Long", "Standard"]), ("difficulty", [None]), ("avoid", [])])
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(md_redis.r, "instance", client)
+    return client
+
+
+@pytest.mark.parametrize("value", [params, "completed-yes", 5, None])
+def test_round_trip(value):
+
+    data = encode_session(value)
+    assert data[:2] == b'J' + bytes([session_version])
+    assert decode_session(data) == value
+
+
+def test_large_values_are_compressed():
+
+    value = ["x" * 2000]
+    data = encode_session(value)
+    assert data[:1] == b'Z' and len(data) < 100
+    assert decode_session(data) == value
+
+
+def test_unknown_version_is_refused():
+
+    data = encode_session(params)
+    with pytest.raises(ValueError, match="Unknown session schema version"):
+        decode_session(data[:1] + bytes([session_version + 1]) + data[2:])
+
+
+def test_legacy_pickle():
+
+    state = od([('search-params', params), ('stage', 'cuisine')])
+    assert decode_session(pickle.dumps(state)) == state
+    with pytest.raises(pickle.UnpicklingError):
+        decode_session(pickle.dumps(os.getcwd))
+
+
+def test_unflatten_mixes_encodings():
+
+    state = od([('search-params', params), ('stage', 'completed'), ('search_window', {'hits': [["a" * 40, True]] * 40})])
+    items = list(flatten(state).items())
+    assert dict(items)['search_window'][:1] == b'Z'
+    assert unflatten(items, Session()) == state
+    #single fields of earlier releases were pickled
+    items.append(('search_batch', pickle.dumps(5)))
+    assert unflatten(items, Session())['search_batch'] == 5
+
+
+def test_legacy_session_is_read_and_converted(fake_redis):
+
+    state = od([('search-params', params), ('stage', 'completed'), ('search_batch', 0)])
+    fake_redis.set("user", pickle.dumps(state))
+    session = md_redis.redis_get("user", ['search-params.meal', 'stage'])
+    assert session.legacy and session['stage'] == 'completed'
+    md_redis.redis_fill("user", session, ['search_window'])
+    session['stage'] = 'completed-yes'
+    md_redis.redis_set("user", session)
+    assert fake_redis.type("user") == b'hash'
+    assert md_redis.redis_get("user")['search-params'] == params
+
+
+def test_partial_write(fake_redis):
+
+    md_redis.redis_set("user", od([('search-params', params), ('stage', 'meal')]))
+    session = md_redis.redis_get("user", ['search-params.meal', 'stage'])
+    session['stage'] = 'time'
+    md_redis.redis_set("user", session)
+    assert fake_redis.hget("user", "stage") == encode_session('time')
+    assert md_redis.redis_get("user") == od([('search-params', params), ('stage', 'time')])